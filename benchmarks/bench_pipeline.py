@@ -0,0 +1,190 @@
+# Time and peak memory of the reference build, ranking and plotting.
+#
+# Inputs are synthetic (see synthetic.py) and written to a work directory,
+# the ID mapping is a local file (CLOVER_ID_MAPPING), so this runs offline.
+# Each case is run --repeat times for the time, and once more with
+# tracemalloc for the peak memory allocated by Python and numpy.
+#
+# Usage:
+# python benchmarks/bench_pipeline.py --json bench.json
+# python benchmarks/bench_pipeline.py --genes 2000 --g2p_rows 100000 --deg_rows 1000 --only rank
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+src_directory = os.path.join(benchmark_directory, "..", "src")
+sys.path.insert(0, src_directory)
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+def measure(fn, repeat):
+	"""Return wall times and the peak traced memory of fn()."""
+	times = []
+	for _ in range(repeat):
+		t = time.perf_counter()
+		fn()
+		times.append(time.perf_counter() - t)
+
+	tracemalloc.start()
+	fn()
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return {"median_s": statistics.median(times), "min_s": min(times), "peak_mb": peak / 2**20}
+
+def git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=benchmark_directory,
+						capture_output=True, text=True, check=True).stdout.strip()
+	except Exception:
+		return None
+
+def prepare(workdir, n_genes, g2p_rows):
+	"""Write the synthetic sources into workdir/data/resources.
+
+	Returns:
+		Dictionary of source name to file path, and the gene table.
+	"""
+	resources = os.path.join(workdir, "data", "resources")
+	os.makedirs(resources, exist_ok=True)
+	gene_table = synthetic.genes(n_genes)
+	files = {
+		"mapping": synthetic.write_mapping(gene_table, os.path.join(resources, "mapping.tsv")),
+		"gtex_HPA": synthetic.write_gtex(gene_table, os.path.join(resources, "rna_tissue_gtex.tsv")),
+		"gene2pubmed": synthetic.write_gene2pubmed(gene_table, os.path.join(resources, "gene2pubmed.gz"), g2p_rows),
+		"DE_Prior": synthetic.write_de_prior(gene_table, os.path.join(resources, "DE_Prior.txt")),
+	}
+	return files, gene_table
+
+def main(args):
+	workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="clover_bench_"))
+	os.makedirs(workdir, exist_ok=True)
+	# data_prep and Clover use data/ in the current directory
+	os.chdir(workdir)
+
+	t = time.perf_counter()
+	files, gene_table = prepare(workdir, args.genes, args.g2p_rows)
+	print(f"synthetic inputs in {workdir} ({time.perf_counter() - t:.1f} s)")
+	os.environ["CLOVER_ID_MAPPING"] = files["mapping"]
+
+	import gini_prepare
+	import g2p_prepare
+	import data_prep
+	from reference import load_reference, precomputed_columns
+	from Clover import Rank, top_genes, reference_columns
+
+	# Same columns as Clover.py, with the precomputed scores
+	def open_reference():
+		return load_reference(os.path.join(workdir, "data"), reference_columns(),
+						list(precomputed_columns().values()))
+
+	cases = {}
+	cases["build/g2p_prepare.main"] = lambda: g2p_prepare.main(files["gene2pubmed"])
+	cases["build/gini_prepare.main"] = lambda: gini_prepare.main(files["gtex_HPA"], 1)
+	manager = data_prep.ResourceManager(1)
+	cases["build/marge_all"] = manager.marge_all
+	cases["rank/load_reference"] = open_reference
+
+	results = {}
+	def run(name, fn):
+		if args.only is not None and not any(pattern in name for pattern in args.only):
+			return
+		results[name] = measure(fn, args.repeat)
+		r = results[name]
+		print(f"{name:40s} median {r['median_s']:8.3f} s  min {r['min_s']:8.3f} s  peak {r['peak_mb']:8.1f} MB")
+
+	for name, fn in cases.items():
+		run(name, fn)
+
+	if not os.path.exists(os.path.join(workdir, "data", "DEPrior_gini_g2p.txt")):
+		# rank cases need the reference
+		g2p_prepare.main(files["gene2pubmed"])
+		gini_prepare.main(files["gtex_HPA"], 1)
+		manager.marge_all()
+	reference = open_reference()
+
+	ranked = None
+	for n_rows in args.deg_rows:
+		for id_type in synthetic.ID_TYPES:
+			df = synthetic.deg_table(gene_table, n_rows, id_type)
+			run(f"rank/Rank.run/{id_type}/{n_rows}",
+				lambda: Rank(df.copy(), None, id_type=id_type, reference=reference).run())
+			if id_type == "hgnc_symbol":
+				ranked = df
+
+	if ranked is not None:
+		from plot_wordcloud import plot_wordclouds
+		top = top_genes(Rank(ranked.copy(), None, id_type="hgnc_symbol", reference=reference).run(), args.wc_top)
+		os.makedirs(os.path.join(workdir, "wordcloud"), exist_ok=True)
+		run(f"plot/plot_wordclouds/{len(ranked)}",
+			lambda: plot_wordclouds(top, os.path.join(workdir, "wordcloud"), processes=1))
+
+	return {
+		"meta": {
+			"commit": git_commit(),
+			"python": platform.python_version(),
+			"numpy": np.__version__,
+			"pandas": pd.__version__,
+			"machine": platform.machine(),
+			"cpu_count": os.cpu_count(),
+			"genes": args.genes,
+			"g2p_rows": args.g2p_rows,
+			"deg_rows": args.deg_rows,
+			"repeat": args.repeat,
+		},
+		"cases": results,
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark of the Clover pipeline on synthetic data.')
+	parser.add_argument("--repeat", "-n",
+					type=int,
+					default=3,
+					help="Number of timed runs of each case")
+	parser.add_argument("--genes",
+					type=int,
+					default=20000,
+					help="Number of genes in the synthetic reference")
+	parser.add_argument("--g2p_rows",
+					type=int,
+					default=2000000,
+					help="Number of rows of the synthetic gene2pubmed")
+	parser.add_argument("--deg_rows",
+					type=int,
+					nargs="+",
+					default=[1000, 20000, 200000],
+					help="Numbers of rows of the DEG tables to rank")
+	parser.add_argument("--wc_top",
+					type=int,
+					default=30,
+					help="Number of genes in each word cloud")
+	parser.add_argument("--only",
+					type=str,
+					nargs="+",
+					default=None,
+					help="Run only cases whose name contains one of these, e.g. rank/")
+	parser.add_argument("--workdir",
+					type=str,
+					default=None,
+					help="A directory for the synthetic inputs and outputs. Default is a new temporary directory")
+	parser.add_argument("--json",
+					type=str,
+					default=None,
+					help="Write the result to this JSON file")
+	args = parser.parse_args()
+	json_file = None if args.json is None else os.path.abspath(args.json)
+	result = main(args)
+	if json_file is not None:
+		with open(json_file, "w") as f:
+			json.dump(result, f, indent=2)
@@ -0,0 +1,57 @@
+# Startup time of Clover in a fresh interpreter.
+#
+# Each case runs in a new python process, like a task of a workflow engine.
+# Times include the interpreter startup.
+#
+# Usage:
+# python benchmarks/bench_startup.py -n 5
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+
+src_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CASES = {
+	"python -c pass": "pass",
+	"import Clover": "import Clover",
+	"import Clover + plot_wordcloud": "import Clover, plot_wordcloud",
+}
+
+def time_case(code, repeat):
+	"""Return wall time in seconds of each run of code in a fresh interpreter."""
+	env = dict(os.environ, PYTHONPATH=src_directory)
+	times = []
+	for _ in range(repeat):
+		t = time.perf_counter()
+		subprocess.run([sys.executable, "-c", code], env=env, check=True)
+		times.append(time.perf_counter() - t)
+	return times
+
+def main(repeat):
+	result = {}
+	for name, code in CASES.items():
+		times = time_case(code, repeat)
+		result[name] = {"median_s": statistics.median(times), "min_s": min(times)}
+		print(f"{name:35s} median {result[name]['median_s']:.3f} s  min {result[name]['min_s']:.3f} s")
+	return result
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Startup time of Clover.')
+	parser.add_argument("--repeat", "-n",
+					type=int,
+					default=5,
+					help="Number of runs of each case")
+	parser.add_argument("--json",
+					type=str,
+					default=None,
+					help="Write the result to this JSON file")
+	args = parser.parse_args()
+	result = main(args.repeat)
+	if args.json is not None:
+		with open(args.json, "w") as f:
+			json.dump(result, f, indent=2)
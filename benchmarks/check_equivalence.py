@@ -0,0 +1,371 @@
+# Check that the fast paths compute what the code they replaced computed.
+#
+# The reference is built offline from synthetic inputs (see synthetic.py),
+# with file:// sources and a local ID mapping (CLOVER_ID_MAPPING), then:
+#   gini:        gini_matrix() against gini_fast() per gene
+#   quantile:    QuantileRank against sklearn QuantileTransformer and pandas rank
+#   download:    resumed and restarted downloads from a local HTTP server
+#   manifest:    stages run again only if their inputs changed
+#   reference:   the binary copy against the TSV
+#   join:        Reference.join() (CSR index) against pandas.merge()
+#   scores:      the score registry against the formulas of Rank.run() before it,
+#                precomputed against calculated scores, numpy against numexpr
+#   matrix:      RankMatrix against Rank of each FDR column
+#   batch:       --batch against ranking each input alone
+# Each check prints ok or FAIL, the exit status is the number of failed checks.
+#
+# Usage:
+# python benchmarks/check_equivalence.py
+# python benchmarks/check_equivalence.py --only join scores --workdir /tmp/clover_check
+
+import os
+import sys
+import glob
+import shutil
+import pathlib
+import zipfile
+import argparse
+import tempfile
+import threading
+import traceback
+import http.server
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+src_directory = os.path.join(benchmark_directory, "..", "src")
+sys.path.insert(0, src_directory)
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+from bench_pipeline import prepare
+
+def legacy_rank(df, table, id_type):
+	"""Rank.run() before the score registry: pandas.merge() and the score functions on Series."""
+	from scores import glint, dowsing, treasure_hunt, ropeway
+	df = df.rename(columns={df.columns[0]: "genename", df.columns[1]: "FDR"})
+	df_merge = pd.merge(df, table[["hgnc_symbol", "ensembl_gene_id", "entrezgene_id", "DE_Prior_Rank", "g2p_rank", "N", "gini_norm"]],
+				  left_on="genename", right_on=id_type, how="left")
+	unique_fdr = np.sort(df_merge["FDR"].unique())
+	if 0 in unique_fdr:
+		df_merge.loc[df_merge["FDR"] == 0, "FDR"] = unique_fdr[1] * 0.001
+	df_merge["Glint"] = glint(df_merge["DE_Prior_Rank"], df_merge["gini_norm"])
+	df_merge["Dowsing"] = dowsing(df_merge["DE_Prior_Rank"], df_merge["gini_norm"], df_merge["FDR"])
+	df_merge["Treasure_Hunt"] = treasure_hunt(df_merge["g2p_rank"], df_merge["Dowsing"])
+	df_merge["Ropeway"] = ropeway(df_merge["g2p_rank"], df_merge["Dowsing"])
+	return df_merge
+
+def check_gini(ctx):
+	from gini_prepare import gini_fast, gini_matrix
+	rng = np.random.default_rng(1)
+	matrix = np.round(rng.lognormal(1, 2, size=(500, 35)), 1)
+	matrix[:50] *= rng.random((50, 35)) < 0.1
+	expected = np.array([gini_fast(row.copy()) for row in matrix])
+	np.testing.assert_allclose(gini_matrix(matrix), expected, rtol=1e-12)
+
+def check_quantile(ctx):
+	import quantile
+	rng = np.random.default_rng(2)
+	# publication counts: many ties
+	values = rng.geometric(0.05, 3000).astype(float)
+	for ties in ["average", "min", "max"]:
+		expected = (pd.Series(values).rank(method=ties).to_numpy() - 1) / (len(values) - 1)
+		np.testing.assert_allclose(quantile.QuantileRank(ties).fit_transform(values), expected, rtol=0, atol=1e-12)
+
+	try:
+		from sklearn.preprocessing import QuantileTransformer
+	except ImportError:
+		print("  sklearn is not installed, ties=sklearn is not compared")
+	else:
+		qt = QuantileTransformer(n_quantiles=len(values), subsample=len(values))
+		expected = qt.fit_transform(values.reshape(-1, 1)).ravel()
+		np.testing.assert_allclose(quantile.QuantileRank("sklearn").fit_transform(values), expected, rtol=0, atol=1e-12)
+
+	# saved breakpoints map the fitted values to the same ranks
+	fname = os.path.join(ctx["workdir"], "quantiles_check.json")
+	for ties in quantile.TIES:
+		transform = quantile.QuantileRank(ties).fit(values)
+		quantile.save(fname, {"N": transform})
+		np.testing.assert_array_equal(quantile.load(fname)["N"].transform(values), transform.transform(values))
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+	"""Serve one payload with an ETag and Range / If-Range, see download._fetch().
+
+	The first response of a server with truncate=True is cut in the middle.
+	"""
+	def do_HEAD(self):
+		self._send(body=False)
+
+	def do_GET(self):
+		self._send(body=True)
+
+	def _send(self, body):
+		server = self.server
+		payload = server.payload
+		start = 0
+		ranged = self.headers.get("Range")
+		if ranged and self.headers.get("If-Range", server.etag) == server.etag:
+			start = int(ranged.split("=")[1].rstrip("-"))
+		self.send_response(206 if start else 200)
+		self.send_header("ETag", server.etag)
+		self.send_header("Content-Length", str(len(payload) - start))
+		self.end_headers()
+		if not body:
+			return
+		server.requests.append(start)
+		if server.truncate:
+			server.truncate = False
+			self.wfile.write(payload[start:len(payload) // 2])
+			self.close_connection = True
+			return
+		self.wfile.write(payload[start:])
+
+	def log_message(self, *args):
+		pass
+
+def check_download(ctx):
+	import download
+	download.time.sleep = lambda seconds: None
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+	server.payload = np.random.default_rng(3).bytes(1 << 20)
+	server.etag = '"v1"'
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = f"http://127.0.0.1:{server.server_address[1]}/file"
+	fname = os.path.join(ctx["workdir"], "download_check.bin")
+	try:
+		# interrupted, resumed from the received bytes
+		server.requests, server.truncate = [], True
+		download.download(url, fname)
+		assert open(fname, "rb").read() == server.payload
+		assert server.requests == [0, len(server.payload) // 2], server.requests
+
+		# a part of another version is not resumed
+		for version in ['"v0"', None]:
+			with open(fname + ".part", "wb") as f:
+				f.write(b"x" * 1000)
+			if version is not None:
+				with open(fname + ".part.version", "w") as f:
+					f.write(version)
+			server.requests, server.truncate = [], False
+			download.download(url, fname)
+			assert open(fname, "rb").read() == server.payload
+			assert not os.path.exists(fname + ".part") and not os.path.exists(fname + ".part.version")
+	finally:
+		server.shutdown()
+		server.server_close()
+
+def build_plan(ctx, dry_run=False):
+	return [stage for stage, reason in ctx["data_prep"].ResourceManager(1).download_all(dry_run)]
+
+def check_manifest(ctx):
+	files = ctx["files"]
+	assert build_plan(ctx) == [], "nothing changed, nothing is run"
+
+	# a new DE_Prior: only its download and the merge
+	de_prior = pd.read_csv(files["DE_Prior"], sep="\t")
+	de_prior["DE_Prior_Rank"] = de_prior["DE_Prior_Rank"][::-1].to_numpy()
+	de_prior.to_csv(files["DE_Prior"], sep="\t", index=False)
+	os.utime(files["DE_Prior"], (1, 1))
+	assert build_plan(ctx, dry_run=True) == ["download_DE_Prior", "merge"]
+	assert build_plan(ctx) == ["download_DE_Prior", "merge"]
+	assert build_plan(ctx) == []
+
+	# a reference without manifest is built again: the code which wrote it is not known
+	os.remove(os.path.join(ctx["workdir"], "data", "build_manifest.json"))
+	assert build_plan(ctx) == ["g2p", "gini", "merge"]
+	assert build_plan(ctx) == []
+
+def check_reference(ctx):
+	import reference
+	tsv_file = os.path.join(ctx["workdir"], "data", f"{reference.REFERENCE_NAME}.txt")
+	table = pd.read_csv(tsv_file, sep="\t", float_precision="round_trip")
+	pd.testing.assert_frame_equal(reference.read_binary(tsv_file), table, check_dtype=False)
+	# a stale binary copy is not used
+	os.utime(tsv_file)
+	assert reference.read_binary(tsv_file) is None
+	reference.write_binary(tsv_file)
+
+def check_join(ctx):
+	from reference import ID_COLUMNS
+	table, ref = ctx["table"], ctx["reference"]
+	columns = ["DE_Prior_Rank", "g2p_rank", "N", "gini_norm"]
+	for id_type in ID_COLUMNS:
+		# duplicated and unknown IDs
+		df = synthetic.deg_table(ctx["gene_table"], 3 * len(ctx["gene_table"]), id_type).rename(columns={id_type: "gene"})
+		expected = pd.merge(df, table[[id_type] + columns], left_on="gene", right_on=id_type, how="left")
+		result = ref.join(df, "gene", id_type, [id_type] + columns)
+		pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+def check_scores(ctx):
+	import scores
+	from Clover import Rank
+	from reference import ID_COLUMNS
+	ref, ref_calculated = ctx["reference"], ctx["reference_calculated"]
+	score_columns = ["Glint", "Dowsing", "Treasure_Hunt", "Ropeway"]
+	for id_type in ID_COLUMNS:
+		df = synthetic.deg_table(ctx["gene_table"], 5000, id_type)
+		expected = legacy_rank(df, ctx["table"], id_type)
+		result = Rank(df.copy(), None, id_type=id_type, reference=ref).run()
+		calculated = Rank(df.copy(), None, id_type=id_type, reference=ref_calculated).run()
+		for score in score_columns:
+			np.testing.assert_allclose(result[score], expected[score], rtol=1e-12, err_msg=score)
+			np.testing.assert_array_equal(result[score], calculated[score], err_msg=f"precomputed {score}")
+
+	if scores.numexpr is None:
+		print("  numexpr is not installed, the numexpr engine is not compared")
+		return
+	rng = np.random.default_rng(4)
+	columns = {"DE_Prior_Rank": rng.random(10000), "specificity": rng.random(10000),
+			"g2p_rank": rng.random(10000), "FDR": rng.random(10000) + 1e-300}
+	expected = scores.evaluate(columns, engine="numpy")
+	for name, values in scores.evaluate(columns, engine="numexpr").items():
+		np.testing.assert_allclose(values, expected[name], rtol=1e-12, err_msg=name)
+
+def check_matrix(ctx):
+	from Clover import RankEngine
+	engine = RankEngine(reference=ctx["reference"])
+	rng = np.random.default_rng(5)
+	df = synthetic.deg_table(ctx["gene_table"], 3000, "hgnc_symbol").drop(columns="logFC")
+	comparisons = ["A", "B", "C"]
+	for c in comparisons:
+		df[c] = rng.random(len(df)) ** 4
+	df.loc[df.index[:10], "B"] = 0
+	df = df.drop(columns="FDR")
+	wide = engine.rank_matrix(df, "hgnc_symbol")
+	tidy = engine.rank_matrix(df, "hgnc_symbol", tidy=True)
+	scores = ["FDR", "Glint", "Dowsing", "Treasure_Hunt", "Ropeway"]
+	for c in comparisons:
+		expected = engine.rank(df[["hgnc_symbol", c]], "hgnc_symbol")
+		for result in [wide[[c] + [f"{s}_{c}" for s in scores[2:]] + ["Glint"]].set_axis(
+					[scores[0]] + scores[2:] + ["Glint"], axis=1),
+				tidy[tidy["comparison"] == c].reset_index(drop=True)]:
+			for score in scores:
+				np.testing.assert_array_equal(result[score].to_numpy(), expected[score].to_numpy(), err_msg=f"{c} {score}")
+
+def check_batch(ctx):
+	import Clover
+	workdir = ctx["workdir"]
+	inputs = os.path.join(workdir, "batch_inputs")
+	os.makedirs(inputs, exist_ok=True)
+	for i, id_type in enumerate(["hgnc_symbol"] * 3):
+		synthetic.deg_table(ctx["gene_table"], 2000, id_type, seed=i).to_csv(os.path.join(inputs, f"contrast{i}.csv"), index=False)
+
+	def run(argv):
+		sys.argv = ["Clover.py"] + argv
+		return Clover.input_args()
+
+	outputs = {}
+	for processes in [1, 2]:
+		output_path = os.path.join(workdir, f"batch_output_{processes}")
+		shutil.rmtree(output_path, ignore_errors=True)
+		Clover.main_batch(run(["--batch", inputs, "--id_type", "hgnc_symbol", "--no_plot",
+						 "-o", output_path, "-p", str(processes)]))
+		outputs[processes] = output_path
+
+	for fname in sorted(glob.glob(os.path.join(inputs, "*.csv"))):
+		name = os.path.splitext(os.path.basename(fname))[0]
+		output_path = os.path.join(workdir, f"single_output_{name}")
+		shutil.rmtree(output_path, ignore_errors=True)
+		args = run(["-i", fname, "--id_type", "hgnc_symbol", "--no_plot", "-o", output_path])
+		Clover.rank_input(pd.read_csv(fname), output_path, args)
+		expected = open(os.path.join(output_path, "rank_result.csv"), "rb").read()
+		for processes, batch_output in outputs.items():
+			result = open(os.path.join(batch_output, name, "rank_result.csv"), "rb").read()
+			assert result == expected, f"{name} with --processes {processes}"
+
+CHECKS = {
+	"gini": check_gini,
+	"quantile": check_quantile,
+	"download": check_download,
+	"manifest": check_manifest,
+	"reference": check_reference,
+	"join": check_join,
+	"scores": check_scores,
+	"matrix": check_matrix,
+	"batch": check_batch,
+}
+
+def build(workdir, n_genes, g2p_rows):
+	"""Build the reference from synthetic sources with data_prep.py.
+
+	Returns:
+		Dictionary of the objects shared by the checks.
+	"""
+	files, gene_table = prepare(workdir, n_genes, g2p_rows)
+	os.environ["CLOVER_ID_MAPPING"] = files["mapping"]
+	# data_prep downloads into data/resources: the sources are kept in sources/
+	sources = os.path.join(workdir, "sources")
+	os.makedirs(sources, exist_ok=True)
+	for name in ["gene2pubmed", "DE_Prior"]:
+		files[name] = shutil.move(files[name], sources)
+	files["gtex_HPA"] = os.path.join(sources, "rna_tissue_gtex.tsv.zip")
+	with zipfile.ZipFile(files["gtex_HPA"], "w", zipfile.ZIP_DEFLATED) as f:
+		f.write(os.path.join(workdir, "data", "resources", "rna_tissue_gtex.tsv"), "rna_tissue_gtex.tsv")
+	os.remove(os.path.join(workdir, "data", "resources", "rna_tissue_gtex.tsv"))
+
+	import data_prep
+	for name, (url, fname) in data_prep.SOURCES.items():
+		data_prep.SOURCES[name] = (pathlib.Path(files[name]).as_uri(), fname)
+	data_prep.ResourceManager(1).download_all()
+
+	ctx = {"workdir": workdir, "files": files, "gene_table": gene_table, "data_prep": data_prep}
+	open_reference(ctx)
+	return ctx
+
+def open_reference(ctx):
+	"""Read the reference into ctx as a table (pandas.read_csv) and as Clover.Rank loads it."""
+	from reference import load_reference, precomputed_columns
+	from Clover import reference_columns
+	resources_path = os.path.join(ctx["workdir"], "data")
+	ctx["table"] = pd.read_csv(os.path.join(resources_path, "DEPrior_gini_g2p.txt"), sep="\t",
+						float_precision="round_trip")
+	ctx["reference"] = load_reference(resources_path, reference_columns(), list(precomputed_columns().values()))
+	# without the precomputed columns, as a reference built before them
+	ctx["reference_calculated"] = load_reference(resources_path, reference_columns())
+
+def main(args):
+	workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="clover_check_"))
+	os.makedirs(workdir, exist_ok=True)
+	# data_prep and Clover use data/ in the current directory
+	os.chdir(workdir)
+	ctx = build(workdir, args.genes, args.g2p_rows)
+
+	names = [name for name in CHECKS if args.only is None or name in args.only]
+	failed = []
+	for name in names:
+		check = CHECKS[name]
+		try:
+			check(ctx)
+			if name == "manifest":
+				# the reference was built again with another DE_Prior
+				open_reference(ctx)
+		except Exception:
+			failed.append(name)
+			print(f"{name:12s} FAIL")
+			traceback.print_exc()
+		else:
+			print(f"{name:12s} ok")
+	print(f"{len(names) - len(failed)} ok, {len(failed)} failed ({workdir})")
+	return len(failed)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check the fast paths of Clover against the code they replaced.')
+	parser.add_argument("--genes",
+					type=int,
+					default=2000,
+					help="Number of genes in the synthetic reference")
+	parser.add_argument("--g2p_rows",
+					type=int,
+					default=100000,
+					help="Number of rows of the synthetic gene2pubmed")
+	parser.add_argument("--only",
+					type=str,
+					nargs="+",
+					choices=list(CHECKS),
+					default=None,
+					help="Run only these checks")
+	parser.add_argument("--workdir",
+					type=str,
+					default=None,
+					help="A directory for the synthetic inputs and outputs. Default is a new temporary directory")
+	sys.exit(main(parser.parse_args()))
@@ -0,0 +1,91 @@
+# Synthetic inputs of Clover for the benchmarks.
+#
+# The files have the format of the real sources, at a given scale:
+# the BioMart ID mapping, HPA GTEx (rna_tissue_gtex.tsv), gene2pubmed,
+# DE_Prior and DEG tables. Gene i is SYN<i> / ENSG<i:011d> / entrez i+1.
+# All generators are seeded, so the same arguments write the same files.
+
+import gzip
+import numpy as np
+import pandas as pd
+
+ID_TYPES = ["hgnc_symbol", "ensembl_gene_id", "entrezgene_id"]
+
+def genes(n_genes):
+	"""Return a pandas.DataFrame of hgnc_symbol, ensembl_gene_id and entrezgene_id of n_genes genes."""
+	i = np.arange(n_genes)
+	return pd.DataFrame({
+		"hgnc_symbol": [f"SYN{g}" for g in i],
+		"ensembl_gene_id": [f"ENSG{g:011d}" for g in i],
+		"entrezgene_id": i + 1})
+
+def write_mapping(gene_table, fname):
+	"""Write the ID mapping in the format of the BioMart response (see convert.py).
+
+	About 1% of the genes have no entrez ID, like the real mapping.
+	"""
+	entrez = gene_table["entrezgene_id"].astype(str).where(gene_table.index % 100 != 7, "")
+	pd.DataFrame({"hgnc_symbol": gene_table["hgnc_symbol"], "ensembl_gene_id": gene_table["ensembl_gene_id"],
+				  "entrezgene_id": entrez}).to_csv(fname, sep="\t", header=False, index=False)
+	return fname
+
+def write_gtex(gene_table, fname, n_tissues=35, seed=0):
+	"""Write a long table of HPA GTEx expression (rna_tissue_gtex.tsv).
+
+	Each gene has n_tissues rows. Expression is log-normal, a part of the
+	genes are tissue-specific.
+	"""
+	rng = np.random.default_rng(seed)
+	n_genes = len(gene_table)
+	tpm = rng.lognormal(1, 2, size=(n_genes, n_tissues))
+	specific = rng.random(n_genes) < 0.1
+	tpm[specific] *= rng.random((specific.sum(), n_tissues)) < 0.1
+	tpm = np.round(tpm, 1).ravel()
+	pd.DataFrame({
+		"Gene": np.repeat(gene_table["ensembl_gene_id"].to_numpy(), n_tissues),
+		"Gene name": np.repeat(gene_table["hgnc_symbol"].to_numpy(), n_tissues),
+		"Tissue": np.tile([f"tissue{t}" for t in range(n_tissues)], n_genes),
+		"TPM": tpm, "pTPM": tpm, "nTPM": tpm}).to_csv(fname, sep="\t", index=False)
+	return fname
+
+def write_gene2pubmed(gene_table, fname, n_rows=2000000, seed=0):
+	"""Write gene2pubmed of n_rows rows, gzip compressed.
+
+	About a third of the rows are human (tax_id 9606), the publication count
+	per gene follows a power law.
+	"""
+	rng = np.random.default_rng(seed)
+	tax_id = rng.choice([9606, 10090, 10116, 7955], size=n_rows, p=[0.35, 0.35, 0.2, 0.1])
+	gene = np.minimum(rng.zipf(1.3, size=n_rows), len(gene_table)) - 1
+	gene_id = np.where(tax_id == 9606, gene_table["entrezgene_id"].to_numpy()[gene], 10**8 + gene)
+	df = pd.DataFrame({"#tax_id": tax_id, "GeneID": gene_id, "PubMed_ID": np.arange(n_rows)})
+	with gzip.open(fname, "wt", compresslevel=1) as f:
+		df.to_csv(f, sep="\t", index=False)
+	return fname
+
+def write_de_prior(gene_table, fname, seed=0):
+	"""Write DE_Prior.txt."""
+	rng = np.random.default_rng(seed)
+	pd.DataFrame({"Gene_Name": gene_table["hgnc_symbol"], "Gene_EntrezID": gene_table["entrezgene_id"],
+				  "DE_Prior_Rank": rng.random(len(gene_table))}).to_csv(fname, sep="\t", index=False)
+	return fname
+
+def deg_table(gene_table, n_rows, id_type, unknown=0.05, seed=0):
+	"""Return a DEG table of n_rows rows (gene ID, FDR, logFC), like Clover.py --input.
+
+	Genes are drawn with replacement if n_rows is larger than the number of
+	genes, and a fraction unknown of the IDs are not in the reference.
+	"""
+	rng = np.random.default_rng(seed)
+	ids = gene_table[id_type].to_numpy()
+	df = pd.DataFrame({
+		id_type: ids[rng.choice(len(ids), size=n_rows, replace=n_rows > len(ids))],
+		"FDR": rng.random(n_rows) ** 4,
+		"logFC": rng.normal(0, 2, n_rows)})
+	df.loc[rng.random(n_rows) < 0.01, "FDR"] = 0
+	is_unknown = rng.random(n_rows) < unknown
+	if id_type == "entrezgene_id":
+		df.loc[is_unknown, id_type] = 10**9 + np.flatnonzero(is_unknown)
+	else:
+		df.loc[is_unknown, id_type] = [f"UNKNOWN{i}" for i in np.flatnonzero(is_unknown)]
+	return df
@@ -1,14 +1,28 @@
 import os
+import glob
+import pathlib
 import argparse
+import importlib.util
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 
-from scores import glint, dowsing, treasure_hunt, ropeway
-from plot_wordcloud import plot_wordcloud
+from scores import evaluate, score_names, ascending, per_comparison, inputs as score_inputs
+from reference import load_reference, rank_columns, precomputed_columns, SPECIFICITY_COLUMNS
+import instrument
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Output formats of rank_result and the optional package each needs
+OUTPUT_PACKAGES = {
+	"csv": None,
+	"csv.gz": None,
+	"csv.zst": "zstandard",
+	"parquet": "pyarrow",
+	"feather": "pyarrow",
+}
+
 """
 Parameter
 """
@@ -35,16 +49,92 @@ def input_args():
 						type=str,
 						default=None,
 						help="FDR column name in input")
+	parser.add_argument("--fdr_columns",
+						type=str,
+						nargs="+",
+						default=None,
+						help="FDR column names in input, one per comparison. All comparisons are ranked at once")
+	parser.add_argument("--tidy",
+						action="store_true",
+						help="With --fdr_columns, write one row per gene and comparison instead of one column per comparison")
+	parser.add_argument("--specificity",
+						type=str,
+						choices=SPECIFICITY_COLUMNS,
+						default="gini_norm",
+						help="Tissue specificity column of the reference used in Glint and Dowsing")
+	parser.add_argument("--scores",
+						type=str,
+						nargs="+",
+						default=None,
+						help="Scores to calculate. Default is all registered scores, with those of $CLOVER_SCORE_PLUGINS")
 	parser.add_argument("--wc_top", "-w",
 						type=int,
 						default=30,
 						help="Rank top N gene to plot word cloud")
+	parser.add_argument("--no_plot",
+						action="store_true",
+						help="Write rank_result.csv only, without word clouds")
+	parser.add_argument("--plot_processes",
+						type=int,
+						default=None,
+						help="Number of processes to plot word clouds. Default is one per score, up to the number of CPUs")
+	parser.add_argument("--wc_cache",
+						type=str,
+						default=None,
+						help="A directory to cache word clouds. Unchanged word clouds are copied instead of plotted")
+	parser.add_argument("--output_format",
+						type=str,
+						choices=list(OUTPUT_PACKAGES),
+						default="csv",
+						help="Format of rank_result. parquet and feather need pyarrow, csv.zst needs zstandard")
+	parser.add_argument("--output_columns",
+						type=str,
+						nargs="+",
+						default=None,
+						help="Columns to write to rank_result. Default is all columns")
+	parser.add_argument("--output_top",
+						type=int,
+						default=None,
+						help="Write only the top N genes of each score to rank_result")
 	parser.add_argument("--output_path","-o",
 						type=str,
 						default=None,
 						help="An output_directory of downloaded reference files and output. Default is current directory.")	
+	parser.add_argument("--chunksize",
+						type=int,
+						default=None,
+						help="Rank the input in chunks of this number of rows to bound memory")
+	parser.add_argument("--batch",
+						type=str,
+						default=None,
+						help="A directory or a glob pattern of input files to rank in one process")
+	parser.add_argument("--manifest",
+						type=str,
+						default=None,
+						help="A file which lists input files to rank in one process, one path per line")
+	parser.add_argument("--contrast_column",
+						type=str,
+						default=None,
+						help="contrast column name in a long-format input. Each contrast is ranked separately")
+	parser.add_argument("--processes", "-p",
+						type=int,
+						default=1,
+						help="Number of processes to rank contrasts in batch mode")
+	parser.add_argument("--metrics",
+						type=str,
+						default=None,
+						help="Write the time, memory and row counts of each stage to this JSON file. Default is $CLOVER_METRICS")
+	parser.add_argument("--profile",
+						type=str,
+						default=None,
+						help="Run under cProfile and write the stats to this file. Default is $CLOVER_PROFILE")
 	return parser.parse_args()
 
+def reference_columns(specificity="gini_norm", scores=None):
+	"""Return the reference columns used by Rank.run(), with the inputs of scores (e.g. of plugin scores)."""
+	columns = rank_columns(specificity)
+	return columns + [c for c in score_inputs(scores) if not c in ["FDR", "specificity"] + columns]
+
 class Rank:
 	"""Return Surprising DEGs scores.
 
@@ -55,11 +145,19 @@ class Rank:
 		gene_column: A column name of gene name or ID. The default is the first column of df.
 		id_type: Choose from ["hgnc_symbol", "ensembl_gene_id", "entrezgene_id"].
 		fdr_column: A column name of FDR. The default is the second column of df.
+		reference: reference.Reference to reuse. The default loads data/DEPrior_gini_g2p.
+		specificity: Tissue specificity column of the reference used in Glint,
+			one of reference.SPECIFICITY_COLUMNS. The default is gini_norm.
+		scores: A list of scores to calculate (see scores.REGISTRY). The default is all registered scores.
 	"""
 
-	def __init__(self, df, output_path, gene_column: str = None, id_type: str = None, fdr_column: str = None):
+	def __init__(self, df, output_path, gene_column: str = None, id_type: str = None, fdr_column: str = None, reference = None,
+			  specificity: str = "gini_norm", scores: list = None):
 		self.df = df
+		self.reference = reference
 		self.id_type = id_type
+		self.specificity = specificity
+		self.columns = rank_columns(specificity)
 		self.output_path = output_path
 
 		# output_path setting if -o option is None, work_directory = os.getcwd()
@@ -85,11 +183,27 @@ class Rank:
 			self.gene_column = 'genename'
 		else:
 			if not (gene_column in self.df.columns):
-				raise ValueError(f"column: {self.gene_column} not in input")
+				raise ValueError(f"column: {gene_column} not in input")
 			else:
 				self.df.rename(columns={gene_column: 'genename'}, inplace=True)
 				self.gene_column = 'genename'
 
+		self._set_fdr_column(fdr_column)
+		self._set_scores(scores)
+		return
+
+	def _set_scores(self, scores):
+		self.scores = score_names() if scores is None else list(scores)
+		self.score_inputs = score_inputs(self.scores)
+		# Inputs of the scores which are not in the input are loaded from the reference
+		self.columns = [c for c in reference_columns(self.specificity, self.scores)
+				  if c in self.columns or not c in self.df.columns]
+		# Scores which do not depend on FDR are read from the reference if it has them
+		self.precomputed = {name: column for name, column in precomputed_columns(self.specificity, self.scores).items()
+					  if not column in self.df.columns}
+		return
+
+	def _set_fdr_column(self, fdr_column):
 		if fdr_column is None:
 			self.df.rename(columns={self.df.columns[1]: 'FDR'}, inplace=True)
 			self.fdr_column = "FDR"
@@ -105,71 +219,589 @@ class Rank:
 	def _get_resources(self):
 		"""Loading resources and merge to df.
 		"""
+		if self.reference is not None:
+			missing = [c for c in self.columns if not (c in self.reference.columns)]
+			if missing:
+				raise ValueError(f"column: {missing} not in reference. Build the reference again with data_prep.py")
+			return self.reference
+
 		resources_path = os.getcwd() + "/data"
-		if not os.path.exists(f"{resources_path}/DEPrior_gini_g2p.txt"):
-			raise ValueError(f"Resource data do not exists in {resources_path}: Please run `python src/data_prep.py`")
-		else:
-			DEPrior_g2p = pd.read_csv(f"{resources_path}/DEPrior_gini_g2p.txt", sep="\t")		
+		# Only columns used in run() are loaded.
+		# The binary copy is used if it is up to date.
+		DEPrior_g2p = load_reference(resources_path, self.columns, list(self.precomputed.values()))
 		return DEPrior_g2p
+
+	def _join(self, resources):
+		"""Join the reference to df.
+
+		Returns:
+			(df_merge, precomputed): precomputed is a dictionary of score name to
+			the values of the precomputed scores, which are not added to df_merge.
+			A reference built before they were added does not have them, they are calculated then.
+		"""
+		rows = resources.lookup(self.df, self.gene_column, self.id_type)
+		df_merge = resources.join(self.df, self.gene_column, self.id_type, self.columns, rows)
+		return df_merge, {name: resources.take(column, rows[1]) for name, column in self.precomputed.items()
+					if column in resources.columns}
 		
-	def run(self):
+	def run(self, fdr_floor: float = None):
 		"""Merge resource score and calculate ranking scores.
-		
+
+		Args:
+			fdr_floor: A value to replace FDR 0. The default is calculated from df
+				(see replace_zero_fdr()). Set this to rank a part of a larger input.
+
 		Returns:
 			df_merge: pandas.DataFrame which adds ranking columns to input df.
 		"""
 		# get resources to calculate ranking
 		try:
-			resources = self._get_resources()
+			with instrument.stage("load_reference"):
+				resources = self._get_resources()
 		except Exception as e:
 			raise ValueError(f"resources ERROR: {e}")
 
-		df_merge = pd.merge(self.df, resources[["hgnc_symbol", "ensembl_gene_id", "entrezgene_id", "DE_Prior_Rank", "g2p_rank", "N", "gini_norm"]], 
-			  left_on=self.gene_column, right_on=self.id_type, how="left")
-		
-		# Replace FDR 0 to second smallest value * 0.001
-		# To avoid dividing by zero error
-		unique_fdr = np.sort(df_merge["FDR"].unique())
-		if 0 in unique_fdr:
-			df_merge.loc[df_merge["FDR"] == 0, "FDR"] =	np.sort(df_merge["FDR"].unique())[1] * 0.001
-		else:
-			pass
-		
-		# Calculate ranking scores
+		# Same as a left pandas.merge() on self.id_type, using the prebuilt index
+		with instrument.stage("join"):
+			df_merge, precomputed = self._join(resources)
 
-		df_merge["Glint"] = glint(df_merge["DE_Prior_Rank"], df_merge["gini_norm"])
-		df_merge["Dowsing"] = dowsing(df_merge["DE_Prior_Rank"], df_merge["gini_norm"], df_merge[self.fdr_column] )
-		df_merge["Treasure_Hunt"] = treasure_hunt(df_merge["g2p_rank"], df_merge["Dowsing"])
-		df_merge["Ropeway"] = ropeway(df_merge["g2p_rank"], df_merge["Dowsing"])
+		with instrument.stage("scores"):
+			# Replace FDR 0 to second smallest value * 0.001
+			# To avoid dividing by zero error
+			if (df_merge["FDR"] == 0).any():
+				df_merge["FDR"] = replace_zero_fdr(df_merge["FDR"].to_numpy(), fdr_floor)
+
+			# Calculate ranking scores in one pass, each once (see scores.evaluate())
+			# on numpy arrays, pandas.Series arithmetic costs more than the scores of a short DEG list.
+			# With precomputed Glint, rareness and g2p_rank_inv, only the FDR terms are calculated.
+			columns = {c: df_merge[self.specificity if c == "specificity" else c].to_numpy() for c in self.score_inputs}
+			columns.update(precomputed)
+			for score, values in evaluate(columns, self.scores).items():
+				df_merge[score] = values
 
 		return df_merge
 	
 
-def asc_set(score):
-	asc = ['FDR', 'Glint']
-	if score in asc:
-		return True
+class RankMatrix(Rank):
+	"""Return Surprising DEGs scores of many comparisons at once.
+
+	The input has one FDR column per comparison. Glint does not depend on FDR
+	and is calculated once, Dowsing, Treasure_Hunt and Ropeway are
+	calculated for all comparisons as 2-D arrays.
+
+	Attributes:
+		df: An expression matrix or DEG lists.
+		gene_column: A column name of gene name or ID. The default is the first column of df.
+		id_type: Choose from ["hgnc_symbol", "ensembl_gene_id", "entrezgene_id"].
+		fdr_columns: A list of FDR column names. The default is all columns except the gene column.
+		reference: reference.Reference to reuse. The default loads data/DEPrior_gini_g2p.
+		specificity: Tissue specificity column of the reference used in Glint. The default is gini_norm.
+		scores: A list of scores to calculate. The default is all registered scores.
+	"""
+
+	def __init__(self, df, output_path, gene_column: str = None, id_type: str = None, fdr_columns: list = None, reference = None,
+			  specificity: str = "gini_norm", scores: list = None):
+		self.fdr_columns = fdr_columns
+		super().__init__(df, output_path, gene_column, id_type, None, reference, specificity, scores)
+
+	def _set_fdr_column(self, fdr_column):
+		if self.fdr_columns is None:
+			self.fdr_columns = [c for c in self.df.columns if c != self.gene_column]
+		missing = [c for c in self.fdr_columns if not (c in self.df.columns)]
+		if missing:
+			raise ValueError(f"column: {missing} not in input")
+		self.fdr_column = None
+		return
+
+	def run(self, tidy: bool = False):
+		"""Merge resource score and calculate ranking scores of all comparisons.
+
+		Args:
+			tidy: If True, return one row per gene and comparison
+				with "comparison" and "FDR" columns.
+				If False, return one row per gene and "<score>_<comparison>" columns.
+
+		Returns:
+			df_merge: pandas.DataFrame which adds ranking columns to input df.
+		"""
+		try:
+			with instrument.stage("load_reference"):
+				resources = self._get_resources()
+		except Exception as e:
+			raise ValueError(f"resources ERROR: {e}")
+
+		with instrument.stage("join"):
+			df_merge, precomputed = self._join(resources)
+
+		# FDR 0 is replaced in each comparison
+		fdr = replace_zero_fdr(df_merge[self.fdr_columns].to_numpy(dtype=float))
+		df_merge[self.fdr_columns] = fdr
+
+		# Reference columns are (genes, 1) and broadcast to FDR (genes, comparisons).
+		# Scores without FDR (e.g. Glint) are calculated once and shared by all comparisons.
+		columns = {c: fdr if c == "FDR" else df_merge[self.specificity if c == "specificity" else c].to_numpy()[:, None]
+			 for c in self.score_inputs}
+		columns.update({name: values[:, None] for name, values in precomputed.items()})
+		scores = {}
+		for score, values in evaluate(columns, self.scores).items():
+			if per_comparison(score):
+				scores[score] = values
+			else:
+				df_merge[score] = np.ravel(values)
+
+		if not tidy:
+			columns = {f"{score}_{c}": values[:, i]
+					for score, values in scores.items() for i, c in enumerate(self.fdr_columns)}
+			return pd.concat([df_merge, pd.DataFrame(columns)], axis=1)
+
+		# comparison-major order: all genes of the first comparison, then the next
+		n = len(self.fdr_columns)
+		df_tidy = df_merge.drop(columns=self.fdr_columns)
+		df_tidy = df_tidy.take(np.tile(np.arange(len(df_tidy)), n)).reset_index(drop=True)
+		df_tidy.insert(1, "comparison", np.repeat(self.fdr_columns, len(df_merge)))
+		df_tidy.insert(2, "FDR", fdr.ravel(order="F"))
+		for score, values in scores.items():
+			df_tidy[score] = values.ravel(order="F")
+		return df_tidy
+
+	def select(self, result, comparison):
+		"""Return the scores of one comparison with the column names of Rank.run().
+
+		Args:
+			result: Output of run(), tidy or not.
+			comparison: One of fdr_columns.
+		"""
+		if "comparison" in result.columns:
+			return result[result["comparison"] == comparison]
+		columns = {comparison: "FDR"}
+		for score in self.scores:
+			if per_comparison(score):
+				columns[f"{score}_{comparison}"] = score
+		return result.drop(columns=[c for c in self.fdr_columns if c != comparison]).rename(columns=columns)
+
+
+class RankEngine:
+	"""Rank many inputs with the reference loaded once.
+
+	Build once and call rank() for each input, e.g. in a service.
+	Nothing is written to disk.
+
+	Attributes:
+		reference: reference.Reference shared by all inputs.
+		specificity: Tissue specificity column of the reference used in Glint. The default is gini_norm.
+		scores: A list of scores to calculate. The default is all registered scores.
+	"""
+
+	def __init__(self, resources_path: str = None, reference = None, specificity: str = "gini_norm", scores: list = None):
+		if reference is None:
+			if resources_path is None:
+				resources_path = os.getcwd() + "/data"
+			reference = load_reference(resources_path, reference_columns(specificity, scores),
+				list(precomputed_columns(specificity, scores).values()))
+		self.reference = reference
+		self.specificity = specificity
+		self.scores = scores
+
+	def rank(self, df, id_type: str, gene_column: str = None, fdr_column: str = None):
+		"""Return the output of Rank.run() for df.
+
+		df is not modified.
+		"""
+		rank_get = Rank(df.copy(deep=False), None, gene_column, id_type, fdr_column, self.reference, self.specificity, self.scores)
+		return rank_get.run()
+
+	def rank_matrix(self, df, id_type: str, gene_column: str = None, fdr_columns: list = None, tidy: bool = False):
+		"""Return the output of RankMatrix.run() for df.
+
+		df is not modified.
+		"""
+		rank_get = RankMatrix(df.copy(deep=False), None, gene_column, id_type, fdr_columns, self.reference, self.specificity, self.scores)
+		return rank_get.run(tidy=tidy)
+
+	def warmup(self):
+		"""Rank a small input once, so that lazy initialization is done before forking workers."""
+		for id_type, index in self.reference.indexes.items():
+			genes = index.keys[:10]
+			self.rank(pd.DataFrame({"gene": genes, "FDR": np.linspace(0, 0.05, len(genes))}), id_type)
+		return
+
+
+def replace_zero_fdr(fdr, floor = None):
+	"""Replace FDR 0 to second smallest value * 0.001, per column.
+
+	To avoid dividing by zero error.
+
+	Args:
+		fdr: numpy array of FDR, 1-D or 2-D (genes x comparisons).
+		floor: A value to replace FDR 0. The default is calculated by fdr_floor().
+
+	Returns:
+		numpy array of FDR without 0.
+	"""
+	fdr = np.array(fdr, dtype=float)
+	if floor is None:
+		floor = fdr_floor(fdr)
+	return np.where(fdr == 0, floor, fdr)
+
+def fdr_floor(fdr):
+	"""Return second smallest value * 0.001 of FDR, per column.
+
+	This is the smallest FDR which is not 0 * 0.001, NaN if there is no such value.
+	"""
+	positive = np.where(fdr > 0, fdr, np.inf).min(axis=0)
+	return np.where(np.isinf(positive), np.nan, positive) * 0.001
+
+def top_index(values, n, ascending=True):
+	"""Return positions of the top n values in O(len(values)).
+
+	Same rows and order as sort_values(ascending=ascending, kind="stable")[0:n]:
+	ties keep input order and NaN are placed last.
+
+	Args:
+		values: 1-D array of a score.
+		n: Number of rows to return.
+		ascending: Sort ascending or descending.
+
+	Returns:
+		numpy array of positions.
+	"""
+	values = np.asarray(values, dtype=float)
+	key = values if ascending else -values
+	nan = np.isnan(key)
+	valid = np.flatnonzero(~nan)
+
+	if n < len(valid):
+		# n-th smallest value, values equal to it are taken in input order
+		kth = np.partition(key[valid], n - 1)[n - 1]
+		below = valid[key[valid] < kth]
+		ties = valid[key[valid] == kth][:n - len(below)]
+		valid = np.sort(np.concatenate([below, ties]))
+
+	order = valid[np.argsort(key[valid], kind="stable")]
+	if len(order) < n:
+		order = np.concatenate([order, np.flatnonzero(nan)[:n - len(order)]])
+	return order[:n]
+
+def top_genes(result, n, scores=None):
+	"""Return the top n rows of each score.
+
+	Args:
+		result: Output of Rank.run().
+		n: Number of genes of each score.
+		scores: A list of score columns. The default is FDR and the registered scores in result.
+
+	Returns:
+		Dictionary of score name to pandas.DataFrame of top n rows sorted by the score.
+	"""
+	if scores is None:
+		scores = ["FDR"] + [score for score in score_names() if score in result.columns]
+	values = result[list(scores)].to_numpy(dtype=float)
+	top = {}
+	for i, score in enumerate(scores):
+		top[score] = result.iloc[top_index(values[:, i], n, ascending(score))]
+	return top
+
+def top_table(top, n = None):
+	"""Return the output of top_genes() as one table.
+
+	Rows are grouped by score, with "score" and "rank" (1 to n) columns.
+	The index is the row of the gene in the full result.
+
+	Args:
+		top: Output of top_genes().
+		n: Number of rows of each score. Default is all rows in top.
+	"""
+	tables = []
+	for score, rows in top.items():
+		rows = rows.iloc[:n].copy()
+		rows.insert(0, "rank", np.arange(1, len(rows) + 1))
+		rows.insert(0, "score", score)
+		tables.append(rows)
+	return pd.concat(tables)
+
+def plot_result(result, output_path, wc_top, plot_processes = None, wc_cache = None):
+	"""Plot the word clouds of top wc_top genes of each score.
+	"""
+	plot_top(top_genes(result, wc_top), output_path, plot_processes, wc_cache)
+	return
+
+def plot_top(top, output_path, plot_processes = None, wc_cache = None):
+	"""Plot the word clouds from the output of top_genes().
+
+	The word clouds are plotted in plot_processes processes (default: one per score, up to the number of CPUs),
+	and copied from wc_cache if the same word cloud is already plotted.
+	"""
+	# matplotlib and wordcloud are imported only when plotting
+	from plot_wordcloud import plot_wordclouds
+
+	os.makedirs(output_path, exist_ok=True)
+	plot_wordclouds(top, output_path, processes=plot_processes, cache_dir=wc_cache)
+	return
+
+def rank_input(df, output_path, args, reference = None):
+	"""Rank one input table and save the result.
+
+	With args.fdr_columns, all comparisons are ranked by RankMatrix and the
+	word clouds are written to wordcloud/<comparison>/.
+	"""
+	if args.fdr_columns is None:
+		with instrument.stage("rank"):
+			rank_get = Rank(df, output_path, args.gene_column, args.id_type, args.fdr_column, reference, args.specificity, args.scores)
+			result = rank_get.run()
+		output = result
+		if args.output_top is not None:
+			output = top_table(top_genes(result, args.output_top))
+		write_result(output, output_path, args.output_format, args.output_columns)
+		if not args.no_plot:
+			with instrument.stage("plot"):
+				plot_result(result, f"{output_path}/wordcloud", args.wc_top, args.plot_processes, args.wc_cache)
+		return result
+
+	with instrument.stage("rank"):
+		rank_get = RankMatrix(df, output_path, args.gene_column, args.id_type, args.fdr_columns, reference, args.specificity, args.scores)
+		result = rank_get.run(tidy=args.tidy)
+	output = result
+	if args.output_top is not None:
+		tables = []
+		for comparison in rank_get.fdr_columns:
+			table = top_table(top_genes(rank_get.select(result, comparison), args.output_top))
+			if not "comparison" in table.columns:
+				table.insert(0, "comparison", comparison)
+			tables.append(table)
+		output = pd.concat(tables)
+	write_result(output, output_path, args.output_format, args.output_columns)
+	if args.no_plot:
+		return result
+	with instrument.stage("plot"):
+		for comparison in rank_get.fdr_columns:
+			plot_result(rank_get.select(result, comparison), f"{output_path}/wordcloud/{comparison}",
+				  args.wc_top, args.plot_processes, args.wc_cache)
+	return result
+
+def check_output_format(output_format):
+	"""Raise ValueError if the package of output_format is not installed."""
+	if not output_format in OUTPUT_PACKAGES:
+		raise ValueError(f"Invalid output format: {output_format}. Expected one of: {list(OUTPUT_PACKAGES)}")
+	package = OUTPUT_PACKAGES[output_format]
+	if package is not None and importlib.util.find_spec(package) is None:
+		raise ValueError(f"output format {output_format} needs {package}: pip install {package}")
+	return
+
+def output_columns(result, columns):
+	"""Return columns of result to write, keeping the columns added by top_table()."""
+	if columns is None:
+		return list(result.columns)
+	missing = [c for c in columns if not (c in result.columns)]
+	if missing:
+		raise ValueError(f"column: {missing} not in rank_result")
+	keys = [c for c in ["comparison", "score", "rank"] if c in result.columns and not c in columns]
+	return keys + list(columns)
+
+def write_result(result, output_path, output_format = "csv", columns = None, append = False):
+	"""Write rank_result.<output_format>.
+
+	The index (row of the input) is written as the first CSV column, restored
+	as the index from parquet, and written as an "index" column to feather.
+
+	Args:
+		result: Output of Rank.run() or top_table().
+		output_path: Output directory.
+		output_format: One of OUTPUT_PACKAGES. csv.gz and csv.zst are compressed CSV.
+		columns: Columns to write. Default is all columns.
+		append: Append to the CSV without header (CSV formats only).
+
+	Returns:
+		A path of the written file.
+	"""
+	fname = f"{output_path}/rank_result.{output_format}"
+	with instrument.stage("write_result"):
+		result = result[output_columns(result, columns)]
+		if output_format == "parquet":
+			result.to_parquet(fname, index=True)
+		elif output_format == "feather":
+			result.reset_index().to_feather(fname)
+		else:
+			# compression is inferred from the file extension
+			result.to_csv(fname, mode="a" if append else "w", header=not append)
+		instrument.count(rows_out=len(result))
+	return fname
+
+def batch_inputs(args):
+	"""List contrasts to rank in batch mode.
+
+	Returns:
+		List of (contrast name, input file path or pandas.DataFrame).
+	"""
+	if args.contrast_column is not None:
+		df = pd.read_csv(args.input, sep = args.sep)
+		if not (args.contrast_column in df.columns):
+			raise ValueError(f"column: {args.contrast_column} not in input")
+		return [(str(name), contrast.drop(columns=args.contrast_column).reset_index(drop=True))
+				for name, contrast in df.groupby(args.contrast_column, sort=False)]
+
+	if args.manifest is not None:
+		with open(args.manifest) as f:
+			files = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+	elif os.path.isdir(args.batch):
+		files = sorted(str(p) for p in pathlib.Path(args.batch).iterdir() if p.is_file())
+	else:
+		files = sorted(glob.glob(args.batch))
+
+	names = [pathlib.Path(file).stem for file in files]
+	duplicated = {name for name in names if names.count(name) > 1}
+	if duplicated:
+		raise ValueError(f"Input file names are duplicated: {sorted(duplicated)}")
+	return list(zip(names, files))
+
+# Shared by the batch workers, set by _init_batch()
+_batch_args = None
+_batch_reference = None
+
+def _init_batch(args, reference):
+	global _batch_args, _batch_reference
+	_batch_args = args
+	_batch_reference = reference
+
+def _rank_contrast(task):
+	"""Rank one contrast in batch mode.
+
+	Returns:
+		(contrast name, error message or None)
+	"""
+	name, source = task
+	args = _batch_args
+	try:
+		if isinstance(source, pd.DataFrame):
+			df = source
+		else:
+			with instrument.stage("read_input"):
+				df = pd.read_csv(source, sep = args.sep)
+				instrument.count(rows_in=len(df))
+		output_path = os.path.join(args.output_path, name.replace(os.sep, "_"))
+		rank_input(df, output_path, args, _batch_reference)
+	except Exception as e:
+		return name, str(e)
+	return name, None
+
+def main_batch(args):
+	"""Rank many contrasts in one process.
+
+	The reference is loaded once and shared by all contrasts.
+	The result of each contrast is written to output_path/<contrast name>.
+	"""
+	if args.output_path is None:
+		raise ValueError("--output_path is required in batch mode")
+	tasks = batch_inputs(args)
+	logger.info(f"Number of contrasts: {len(tasks)}")
+
+	os.makedirs(args.output_path, exist_ok=False)
+	with instrument.stage("load_reference"):
+		reference = load_reference(os.getcwd() + "/data", reference_columns(args.specificity, args.scores),
+			list(precomputed_columns(args.specificity, args.scores).values()))
+
+	# Stages of the workers are not collected with --processes
+	if args.processes > 1:
+		with Pool(args.processes, initializer=_init_batch, initargs=(args, reference)) as p:
+			status = p.map(_rank_contrast, tasks, chunksize=1)
 	else:
-		return False
+		_init_batch(args, reference)
+		status = [_rank_contrast(task) for task in tasks]
+
+	failed = [(name, e) for name, e in status if e is not None]
+	for name, e in failed:
+		logger.error('contrast %s ERROR: %s' % (name, e))
+	if failed:
+		raise ValueError(f"{len(failed)} of {len(tasks)} contrasts failed")
+	return [name for name, e in status]
+
+def main_chunked(args):
+	"""Rank a large input chunk by chunk with bounded memory.
+
+	Each chunk is joined to the reference, scored and appended to
+	rank_result.csv. FDR 0 is replaced by one value for the whole input,
+	found by a pre-pass over the FDR column. Only top wc_top genes of each
+	score are kept to plot word clouds.
+	"""
+	if args.fdr_columns is not None:
+		raise ValueError("--chunksize does not support --fdr_columns")
+	if args.output_path is None:
+		raise ValueError("--output_path is required with --chunksize")
+	if not args.output_format.startswith("csv"):
+		raise ValueError("--chunksize supports only csv, csv.gz and csv.zst output formats")
+
+	columns = pd.read_csv(args.input, sep = args.sep, nrows=0).columns
+	fdr_column = columns[1] if args.fdr_column is None else args.fdr_column
+
+	# pre-pass: smallest FDR which is not 0
+	with instrument.stage("fdr_floor"):
+		positive = np.inf
+		for chunk in pd.read_csv(args.input, sep = args.sep, usecols=[fdr_column], chunksize=args.chunksize):
+			fdr = chunk[fdr_column].to_numpy(dtype=float)
+			positive = min(positive, np.where(fdr > 0, fdr, np.inf).min(initial=np.inf))
+		floor = fdr_floor(np.array([positive]))
+
+	output_path = os.path.abspath(args.output_path)
+	os.makedirs(output_path, exist_ok=False)
+	with instrument.stage("load_reference"):
+		reference = load_reference(os.getcwd() + "/data", reference_columns(args.specificity, args.scores),
+			list(precomputed_columns(args.specificity, args.scores).values()))
+
+	# Number of top rows of each score to keep, for the word clouds and --output_top
+	n_top = max(0 if args.no_plot else args.wc_top, args.output_top or 0)
+
+	top = {}
+	n_row = 0
+	for chunk in pd.read_csv(args.input, sep = args.sep, chunksize=args.chunksize):
+		with instrument.stage("chunk"):
+			instrument.count(rows_in=len(chunk))
+			rank_get = Rank(chunk.reset_index(drop=True), None, args.gene_column, args.id_type, args.fdr_column, reference, args.specificity, args.scores)
+			result = rank_get.run(fdr_floor=floor)
+			result.index += n_row
+			if args.output_top is None:
+				write_result(result, output_path, args.output_format, args.output_columns, append=(n_row > 0))
+			n_row += len(result)
+
+			if n_top == 0:
+				continue
+
+			# Keep top n_top rows of each score, ties keep input order
+			with instrument.stage("top_genes"):
+				for score, result_top in top_genes(result, n_top).items():
+					if score in top:
+						result_top = top_genes(pd.concat([top[score], result_top]), n_top, [score])[score]
+					top[score] = result_top
+
+	if args.output_top is not None:
+		write_result(top_table(top, args.output_top), output_path, args.output_format, args.output_columns)
+	if not args.no_plot:
+		with instrument.stage("plot"):
+			plot_top({score: rows.iloc[:args.wc_top] for score, rows in top.items()},
+				f"{output_path}/wordcloud", args.plot_processes, args.wc_cache)
+	return n_row
 
 def main(args):
 
+	check_output_format(args.output_format)
+
+	if args.chunksize is not None:
+		return main_chunked(args)
+
+	if args.batch is not None or args.manifest is not None or args.contrast_column is not None:
+		return main_batch(args)
+
 	work_directory = os.getcwd()
 
 	try:
-		df = pd.read_csv(args.input, sep = args.sep)
+		with instrument.stage("read_input"):
+			df = pd.read_csv(args.input, sep = args.sep)
+			instrument.count(rows_in=len(df))
 	except Exception as e:
 		logger.error('input load ERROR: %s' % (e))
 
-	rank_get = Rank(df, args.output_path, args.gene_column, args.id_type, args.fdr_column)
-	result = rank_get.run()
-	result.to_csv(f"{args.output_path}/rank_result.csv")
-	os.makedirs(f"{args.output_path}/wordcloud", exist_ok=True)
-	for score in ["FDR", "Glint", "Dowsing", "Treasure_Hunt", "Ropeway"]:
-		sorted_result = result.sort_values(by=score, ascending=asc_set(score))
-		plot_wordcloud(sorted_result[0:args.wc_top], score, f"{args.output_path}/wordcloud")
+	result = rank_input(df, args.output_path, args)
 	return result
 
 if __name__ == '__main__':
 	args = input_args()
-	main(args)
+	with instrument.session(args.metrics, args.profile):
+		main(args)
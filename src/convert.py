@@ -1,50 +1,191 @@
-from biomart import BiomartServer
+# ID mapping between hgnc_symbol, ensembl_gene_id and entrezgene_id.
+#
+# The mapping is downloaded from Ensembl BioMart once and cached in
+# data/resources/ensembl_mappings_v1.tsv.gz (tab-separated hgnc_symbol,
+# ensembl_gene_id, entrezgene_id, no header; same as the BioMart response).
+# A local mapping file of the same format can be used instead by setting
+# CLOVER_ID_MAPPING or passing mapping_file, e.g. on air-gapped nodes.
+#
+# Usage (download the mapping again):
+# python3 convert.py --refresh
+
+import io
+import os
+import csv
+import gzip
+import argparse
+import numpy as np
 import pandas as pd
 
+from reference import IdIndex
+
 import logging
 logger = logging.getLogger(__name__)
 
-def get_ensembl_mappings():
+# Change this when the format of the cache is changed
+MAPPING_VERSION = 1
+MAPPING_ENV = "CLOVER_ID_MAPPING"
+
+ID_TYPES = ["hgnc_symbol", "ensembl_gene_id", "entrezgene_id"]
+# ID to convert from, if df has several ID columns
+ID_PRIORITY = ["ensembl_gene_id", "entrezgene_id", "hgnc_symbol"]
+
+# Parsed mappings of this process, keyed by mapping file
+_mappings = {}
+
+def default_mapping_file():
+	"""Return the path of the mapping cache in the reference folder."""
+	return os.path.join(os.getcwd(), "data", "resources", f"ensembl_mappings_v{MAPPING_VERSION}.tsv.gz")
+
+def fetch_biomart():
 	"""Connect ensembl biomart through API.
-	
+
 	Returns:
-		to_genesymbol: Dictionary which keys are ensembl_gene_id or entrezgene_id and value is hgnc_symbol.
-		to_entrezgene: Dictionary which keys are ensembl_gene_id or hgnc_symbol and value is entrezgene_id.
-		to_ensembl: Dictionary which keys are hgnc_symbol or entrezgene_id and value is ensembl_gene_id.
+		data: Tab-separated hgnc_symbol, ensembl_gene_id and entrezgene_id.
 	"""
+	from biomart import BiomartServer
+
 	# Set up a connection to the server. Change the mirror site to your location.
 	server = BiomartServer( "http://asia.ensembl.org/biomart" )
 	# server = BiomartServer( "http://www.ensembl.org/biomart" )
 	mart = server.datasets['hsapiens_gene_ensembl']
 	
 	attributes = ['hgnc_symbol', 'ensembl_gene_id', "entrezgene_id"]
+	logger.info("Downloading ID mapping from biomart")
 	response = mart.search({'attributes': attributes}) 
-	data = response.raw.data.decode('ascii')
+	return response.raw.data.decode('ascii')
+
+def read_mapping_file(mapping_file):
+	"""Read a mapping file, gzip compressed or not."""
+	opener = gzip.open if mapping_file.endswith(".gz") else open
+	with opener(mapping_file, "rt", encoding="ascii") as f:
+		return f.read()
+
+def load_mapping_data(mapping_file=None, refresh=False):
+	"""Return the mapping data, download only if mapping_file does not exist.
 
-	to_genesymbol = {}
-	to_entrezgene = {}
-	to_ensembl = {}
-	# Store the data in a dict
-	for line in data.splitlines():
-		line = line.split('\t')
-		# The entries are in the same order as in the `attributes` variable
-		gene_symbol = line[0]
-		ensembl_gene = line[1]
-		entrezgene_id = line[2]
+	Args:
+		mapping_file: A local mapping file. The default is $CLOVER_ID_MAPPING, or the cache.
+			Downloaded data is saved to this file.
+		refresh: Download from biomart and overwrite mapping_file.
 
-		# Some of these keys may be an empty string.
-		to_genesymbol[ensembl_gene] = gene_symbol
-		to_genesymbol[entrezgene_id] = gene_symbol
+	Returns:
+		data: Tab-separated hgnc_symbol, ensembl_gene_id and entrezgene_id.
+	"""
+	if mapping_file is None:
+		mapping_file = os.environ.get(MAPPING_ENV, default_mapping_file())
+	if os.path.exists(mapping_file) and not refresh:
+		logger.info(f"Using ID mapping: {mapping_file}")
+		return read_mapping_file(mapping_file)
+
+	data = fetch_biomart()
+	os.makedirs(os.path.dirname(os.path.abspath(mapping_file)), exist_ok=True)
+	opener = gzip.open if mapping_file.endswith(".gz") else open
+	with opener(mapping_file, "wt", encoding="ascii") as f:
+		f.write(data)
+	logger.info(f"Saved ID mapping: {mapping_file}")
+	return data
+
+class IdMapping(object):
+	"""ID mapping table held as categorical columns.
+
+	Conversions are vectorized joins. A lookup table is built once for each
+	conversion direction.
+
+	Attributes:
+		table: pandas.DataFrame of hgnc_symbol, ensembl_gene_id and
+			entrezgene_id (categorical, missing IDs are empty strings).
+	"""
+	def __init__(self, table):
+		self.table = table
+		self._lookups = {}
 
-		to_entrezgene[ensembl_gene] = entrezgene_id
-		to_entrezgene[gene_symbol] = entrezgene_id
+	def _lookup(self, from_id, to_id, multi):
+		key = (from_id, to_id, multi)
+		if not key in self._lookups:
+			pairs = self.table[[from_id, to_id]]
+			# An empty ID is a missing ID, not a key
+			pairs = pairs[pairs[from_id] != ""]
+			if multi != "all":
+				pairs = pairs.drop_duplicates(subset=from_id, keep=multi)
+			self._lookups[key] = (IdIndex(pairs[from_id].astype(str).to_numpy()),
+							  pairs[to_id].astype(str).to_numpy(dtype=object))
+		return self._lookups[key]
 
-		to_ensembl[entrezgene_id] = ensembl_gene
-		to_ensembl[gene_symbol] = ensembl_gene
+	def convert(self, values, from_id, to_id, multi="last"):
+		"""Convert IDs.
 
-	return to_genesymbol, to_entrezgene, to_ensembl
+		Args:
+			values: array-like of IDs of from_id. Values are compared as str.
+			from_id: ID type of values.
+			to_id: ID type to convert to.
+			multi: How to handle one ID with several mapping rows.
+				"last": the last row in the mapping (same as the previous dict mapping),
+				"first": the first row, "all": all rows.
 
-def add_ids(df, hgnc_symbol = "hgnc_symbol", ensembl_gene_id = "ensembl_gene_id", entrezgene_id = "entrezgene_id"):
+		Returns:
+			left: Positions in values, repeated if multi="all" and the ID has several rows.
+			converted: numpy array of IDs of to_id, NaN if not found.
+				An ID mapped to an empty value (e.g. a gene without entrezgene_id) is "",
+				same as the previous dict mapping, so it is not dropped by dropna().
+		"""
+		if not multi in ("last", "first", "all"):
+			raise ValueError(f"Invalid multi: {multi}")
+		index, converted = self._lookup(from_id, to_id, multi)
+		left, right = index.lookup(np.asarray(values, dtype=object).astype(str).astype(object))
+		return left, pd.api.extensions.take(converted, right, allow_fill=True)
+
+def get_mapping(mapping_file=None, refresh=False):
+	"""Return the ID mapping from the cache, or from ensembl biomart.
+
+	The mapping is parsed once per process.
+
+	Args:
+		mapping_file: A local mapping file. The default is $CLOVER_ID_MAPPING, or the cache.
+		refresh: Download from biomart and overwrite the cache.
+
+	Returns:
+		IdMapping.
+	"""
+	if mapping_file is None:
+		mapping_file = os.environ.get(MAPPING_ENV, default_mapping_file())
+	if mapping_file in _mappings and not refresh:
+		return _mappings[mapping_file]
+
+	data = load_mapping_data(mapping_file, refresh)
+
+	# The entries are in the same order as in the `attributes` of fetch_biomart()
+	# Some of these IDs may be an empty string.
+	table = pd.read_csv(io.StringIO(data), sep="\t", header=None, names=ID_TYPES,
+					 dtype=str, na_filter=False, quoting=csv.QUOTE_NONE)
+	_mappings[mapping_file] = IdMapping(table.astype("category"))
+	return _mappings[mapping_file]
+
+def get_ensembl_mappings(mapping_file=None, refresh=False):
+	"""Return ID mappings as dictionaries.
+
+	Kept for compatibility, add_ids() uses get_mapping().
+
+	Args:
+		mapping_file: A local mapping file. The default is $CLOVER_ID_MAPPING, or the cache.
+		refresh: Download from biomart and overwrite the cache.
+	
+	Returns:
+		to_genesymbol: Dictionary which keys are ensembl_gene_id or entrezgene_id and value is hgnc_symbol.
+		to_entrezgene: Dictionary which keys are ensembl_gene_id or hgnc_symbol and value is entrezgene_id.
+		to_ensembl: Dictionary which keys are hgnc_symbol or entrezgene_id and value is ensembl_gene_id.
+	"""
+	table = get_mapping(mapping_file, refresh).table.astype(str)
+	mappings = []
+	for to_id in ["hgnc_symbol", "entrezgene_id", "ensembl_gene_id"]:
+		mapping = {}
+		for from_id in ID_TYPES:
+			if from_id != to_id:
+				mapping.update(zip(table[from_id], table[to_id]))
+		mappings.append(mapping)
+	return tuple(mappings)
+
+def add_ids(df, hgnc_symbol = "hgnc_symbol", ensembl_gene_id = "ensembl_gene_id", entrezgene_id = "entrezgene_id", mapping_file = None, multi = "last"):
 	"""Add hgnc_symbol, ensembl_gene_id, or entrezgene_id.
 
 	This will add hgnc_symbol, ensembl_gene_id, or entrezgene_id to df if there is no corresponding column.
@@ -55,6 +196,9 @@ def add_ids(df, hgnc_symbol = "hgnc_symbol", ensembl_gene_id = "ensembl_gene_id"
 		hgnc_symbol: corresponding column name to hgnc_symbol (gene name).
 		ensembl_gene_id: corresponding column name to ensembl_gene_id, start from ENSG**********.
 		entrezgene_id: corresponding column name to entrezgene_id (only number).
+		mapping_file: A local mapping file. The default is $CLOVER_ID_MAPPING, or the cache.
+		multi: How to handle one ID with several mapping rows, see IdMapping.convert().
+			With "all", a row of df is repeated for each mapped ID.
 	
 	Returns:
 		df_modify: pandas.DataFrame which added an id and symbol, also, changes column names.
@@ -65,28 +209,32 @@ def add_ids(df, hgnc_symbol = "hgnc_symbol", ensembl_gene_id = "ensembl_gene_id"
 		entrezgene_id: "entrezgene_id"}
     
 	df_modify = df.rename(columns=attributes)
-	df_modify
 
-	to_genesymbol, to_entrezgene, to_ensembl = get_ensembl_mappings()
+	mapping = get_mapping(mapping_file)
 
-	ids_in = set(df_modify.columns) & set(attributes.values())
-	ids_not_in = set(attributes.values()) - ids_in
+	ids_in = [attr for attr in ID_PRIORITY if attr in df_modify.columns]
+	ids_not_in = [attr for attr in ID_TYPES if not attr in ids_in]
+	if not ids_in:
+		raise ValueError(f"No ID column in df: {list(attributes)}")
 
+	# Convert from the most stable ID in df
+	ref = ids_in[0]
 	for attr in ids_not_in:
-		ref = list(ids_in)[0]
-        
-		if attr == hgnc_symbol: # convert from ensembl_gene_id or entrezgene_id to hgnc_symbol
-			logger.info(f"convert hgnc_symbol from {ref}")
-			df_modify[attr] = df_modify[ref].astype(str).map(to_genesymbol)
-            
-		elif attr == ensembl_gene_id: # convert from hgnc_symbol or entrezgene_id to ensembl_gene_id
-			logger.info(f"convert ensembl_gene_id from {ref}")
-			df_modify[attr] = df_modify[ref].astype(str).map(to_ensembl)
-            
-		elif attr == entrezgene_id: # convert from hgnc_symbol or ensembl_gene_id to entrezgene_id
-			logger.info(f"convert entrezgene_id from {ref}")
-			df_modify[attr] = df_modify[ref].astype(str).map(to_entrezgene)
-            
-		else:
-			logger.error("convert error")
+		logger.info(f"convert {attr} from {ref}")
+		left, converted = mapping.convert(df_modify[ref].astype(str), ref, attr, multi)
+		if len(left) != len(df_modify):
+			df_modify = df_modify.take(left).reset_index(drop=True)
+		df_modify[attr] = converted
 	return df_modify
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Download ID mapping from ensembl biomart to the cache.')
+	parser.add_argument("--refresh",
+					action="store_true",
+					help="Download again and overwrite the cache")
+	parser.add_argument("--mapping_file",
+					type=str,
+					default=None,
+					help="A path of the cache. Default is $CLOVER_ID_MAPPING or data/resources/ensembl_mappings_v%d.tsv.gz" % MAPPING_VERSION)
+	args = parser.parse_args()
+	load_mapping_data(args.mapping_file, args.refresh)
@@ -8,7 +8,22 @@
 # python3 data_prep.py -t 4 -b /path/to/base/folder
 #
 # -t: number of threads to run gini_prepare.main() parallel.
+# --gini_backend: run the -t workers as threads (default), processes or serial (see gini_prepare.gini_rows()).
 # -b: base folder name of downloaded reference files.
+# --refresh_mappings: download ID mapping from biomart again.
+# --dry_run: only report which stages would be rebuilt.
+# --mirror: download from a mirror (URL or local folder) instead of the original URLs.
+# --checksums: sha256sum file of the downloads to check.
+# --metrics / --profile: write the time and memory of each stage (see instrument.py).
+# --quantiles: map g2p_rank and gini_norm_rank with saved breakpoints instead of fitting them.
+# --ties: rank of tied values in g2p_rank and gini_norm_rank (see quantile.py).
+#
+# The downloads run in parallel and are resumed if interrupted (see download.py).
+# data/build_manifest.json records the inputs of each stage
+# (download, g2p count, gini, merge); a stage is rebuilt only if they changed.
+#
+# ID mapping from biomart is cached in data/resources/ensembl_mappings_v1.tsv.gz,
+# set CLOVER_ID_MAPPING to use a local mapping file instead (see convert.py).
 #
 
 import os
@@ -17,17 +32,18 @@ import argparse
 import logging
 import pathlib
 import pandas as pd
-import numpy as np
 from multiprocessing import Pool
-
-import urllib.request
-import gzip
-import shutil
-from zipfile import ZipFile
-from sklearn.preprocessing import QuantileTransformer
+from concurrent.futures import ThreadPoolExecutor
 
 import gini_prepare
 import g2p_prepare
+import reference
+import convert
+import download
+import instrument
+import quantile
+import scores
+from manifest import BuildManifest, code_version, remote_version
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +54,13 @@ filename="download.log")
 work_directory = os.getcwd()
 base_folder_default = f"{work_directory}/data"
 
+# name: (url, file name in the resource folder)
+SOURCES = {
+	"gene2pubmed": ('https://ftp.ncbi.nlm.nih.gov/gene/DATA/gene2pubmed.gz', 'gene2pubmed.gz'),
+	"gtex_HPA": ('https://www.proteinatlas.org/download/rna_tissue_gtex.tsv.zip', 'rna_tissue_gtex.tsv.zip'),
+	"DE_Prior": ('https://raw.githubusercontent.com/maggiecrow/DEprior/master/DE_Prior.txt', 'DE_Prior.txt'),
+}
+
 class ResourceManager(object):
 	"""Manage the download, caching, access, and modification of resource files.
 
@@ -46,77 +69,208 @@ class ResourceManager(object):
 
 	current_directory
 	└── data
+		├── build_manifest.json
 		├── DEPrior_gini_g2p.txt
+		├── DEPrior_gini_g2p.bin
+		├── DEPrior_gini_g2p_quantiles.json
 		└── resource
 			├── DE_Prior.txt
-			├── gene2pubmed
 			├── gene2pubmed.gz
 			├── gene2pubmed_human_count.txt
 			├── rna_tissue_gtex_gini_norm.tsv
-			├── rna_tissue_gtex.tsv
 			└── rna_tissue_gtex.tsv.zip
 
 	Attributes:
 		thread: A thread number to run gini_prepare.main() parallel.
+		mirror: A base URL or a local folder to download from instead of the
+			original URLs. The default is $CLOVER_MIRROR.
+		checksums: Dictionary of file name to the expected sha256.
+		quantiles: A file of quantile breakpoints saved by a previous build
+			(DEPrior_gini_g2p_quantiles.json). g2p_rank and gini_norm_rank are
+			mapped with it instead of fitted, so that ranks of unchanged values
+			stay the same. The default fits and saves the breakpoints.
+		ties: Rank of tied values, one of quantile.TIES.
+		gini_backend: Parallel backend of gini_prepare.main(), one of gini_prepare.BACKENDS.
 	"""
-	def __init__(self, thread):
+	def __init__(self, thread, mirror=None, checksums=None, quantiles=None, ties="sklearn", gini_backend="threads"):
 
 		self.base_folder = base_folder_default
 		self.resource_folder = self._get_resource_folder()
 		logger.info('Using %s as resource folder.' % self.resource_folder)
 		self.thread = thread
+		self.mirror = mirror
+		self.checksums = checksums or {}
+		self.quantiles = quantiles
+		self.ties = ties
+		self.gini_backend = gini_backend
 
 	def get_g2p(self):
-		fname = os.path.join(self.resource_folder, 'gene2pubmed')
-		if not os.path.exists(fname):
-			url = 'https://ftp.ncbi.nlm.nih.gov/gene/DATA/gene2pubmed.gz'
-			download_gzip(url, fname)
-		else:
-			logger.warning(fname + ' already exists. Skip Download.')
-		return fname
+		# gene2pubmed is read from the .gz file, it is not extracted.
+		return self._get_source("gene2pubmed")
 
 	def get_gtex_HPA(self):
-		fname = os.path.join(self.resource_folder, 'rna_tissue_gtex.tsv')
-		if not os.path.exists(fname):
-			url = 'https://www.proteinatlas.org/download/rna_tissue_gtex.tsv.zip'
-			download_zip(url, fname)
-		else:
-			logger.warning(fname + ' already exists. Skip Download.')
-		return fname
+		# rna_tissue_gtex.tsv is read from the .zip file, it is not extracted.
+		return self._get_source("gtex_HPA")
 	
 	def get_DE_Prior(self):
-		fname = os.path.join(self.resource_folder, 'DE_Prior.txt')
+		return self._get_source("DE_Prior")
+
+	def _get_source(self, name):
+		url, fname = SOURCES[name]
+		fname = os.path.join(self.resource_folder, fname)
 		if not os.path.exists(fname):
-			url = 'https://raw.githubusercontent.com/maggiecrow/DEprior/master/DE_Prior.txt'
-			download_url(url, fname)
+			self._download(name)
 		else:
 			logger.warning(fname + ' already exists. Skip Download.')
 		return fname
 
+	def _url(self, name):
+		url, fname = SOURCES[name]
+		return download.mirror_url(url, fname, self.mirror)
 
-	def download_all(self):
-		g2p_file = self.get_g2p()
-		gtex_HPA_file = self.get_gtex_HPA()
-		de_prior_file = self.get_DE_Prior()
+	def _download(self, name):
+		url, fname = SOURCES[name]
+		download.download(self._url(name), os.path.join(self.resource_folder, fname),
+					self.checksums.get(fname))
 
-		gini_preprocess = os.path.join(self.resource_folder, 'rna_tissue_gtex_gini_norm.tsv')
-		g2p_preprocess = os.path.join(self.resource_folder, 'gene2pubmed_human_count.txt')
+	def download_all(self, dry_run=False):
+		"""Download resources and build the reference.
 
-		if not os.path.exists(g2p_preprocess):
-			g2p_prepare.main(g2p_file)
-		else:
-			logger.warning(g2p_preprocess + ' already exists. Skip preprocess.')
+		Only stages whose inputs changed are run: a download if the remote
+		ETag/Last-Modified changed, a preprocess or the merge if the content of
+		an input file or the code changed (see manifest.BuildManifest).
 
-		if not os.path.exists(gini_preprocess):
-			gini_prepare.main(gtex_HPA_file, self.thread)
-		else:
-			logger.warning(gini_preprocess + ' already exists. Skip preprocess.')
+		Args:
+			dry_run: Only report the stages which would be run.
 
-		if not os.path.exists(f"{self.base_folder}/DEPrior_gini_g2p.txt"):
-			self.marge_all()
+		Returns:
+			List of (stage, reason) of the stages which were (or would be) run.
+		"""
+		manifest = BuildManifest(os.path.join(self.base_folder, "build_manifest.json"))
+		self._plan = []
+		mapping_file = os.environ.get(convert.MAPPING_ENV, convert.default_mapping_file())
+
+		self._download_stages(manifest, dry_run)
+
+		g2p_file = os.path.join(self.resource_folder, SOURCES["gene2pubmed"][1])
+		gtex_HPA_file = os.path.join(self.resource_folder, SOURCES["gtex_HPA"][1])
+		de_prior_file = os.path.join(self.resource_folder, SOURCES["DE_Prior"][1])
+
+		gini_preprocess = os.path.join(self.resource_folder, 'rna_tissue_gtex_gini_norm.tsv')
+		g2p_preprocess = os.path.join(self.resource_folder, 'gene2pubmed_human_count.txt')
+		merged = os.path.join(self.base_folder, 'DEPrior_gini_g2p.txt')
+		merge_inputs = [g2p_preprocess, gini_preprocess, de_prior_file]
+		merge_outputs = [merged, reference.binary_path(merged)]
+		if self.quantiles is None:
+			merge_outputs.append(self._quantiles_path())
+		else:
+			merge_inputs.append(self.quantiles)
+
+		self._run_stage(manifest, "g2p", ["download_gene2pubmed"],
+				lambda: manifest.signature([g2p_file, mapping_file], code=code_version("g2p_prepare", "convert")),
+				[g2p_preprocess], lambda: g2p_prepare.main(g2p_file), dry_run)
+
+		self._run_stage(manifest, "gini", ["download_gtex_HPA"],
+				lambda: manifest.signature([gtex_HPA_file, mapping_file], code=code_version("gini_prepare", "convert")),
+				[gini_preprocess], lambda: gini_prepare.main(gtex_HPA_file, self.thread, backend=self.gini_backend), dry_run)
+
+		self._run_stage(manifest, "merge", ["g2p", "gini", "download_DE_Prior"],
+				lambda: manifest.signature(merge_inputs, code=code_version("data_prep", "reference", "quantile", "scores"), ties=self.ties,
+							precomputed=self._precomputed()),
+				merge_outputs, self.marge_all, dry_run)
+		return self._plan
+
+	def _download_stages(self, manifest, dry_run):
+		"""Run the download stages of download_all() in parallel."""
+		stages = {}
+		for name, (url, fname) in SOURCES.items():
+			stage = f"download_{name}"
+			url = self._url(name)
+			signature = lambda url=url, stage=stage: self._remote_signature(manifest, stage, url, dry_run)
+			outputs = [os.path.join(self.resource_folder, fname)]
+			if self._check_stage(manifest, stage, [], signature, outputs, dry_run):
+				stages[stage] = (name, signature, outputs)
+		if dry_run or not stages:
+			return
+
+		# Downloads are I/O bound, run all of them at once
+		with instrument.stage("download"), ThreadPoolExecutor(max_workers=len(stages)) as executor:
+			futures = {stage: executor.submit(self._download, name)
+			  for stage, (name, signature, outputs) in stages.items()}
+
+		failed = []
+		for stage, future in futures.items():
+			name, signature, outputs = stages[stage]
+			if future.exception() is not None:
+				logger.error(f"{stage} failed: {future.exception()}")
+				failed.append(f"{stage} ({future.exception()})")
+				continue
+			self._record_stage(manifest, stage, signature, outputs)
+		if failed:
+			raise RuntimeError(f"Download failed: {', '.join(failed)}. See download.log")
+
+	def _remote_signature(self, manifest, stage, url, dry_run=False):
+		remote = remote_version(url)
+		record = manifest.stages.get(stage)
+		if record is None:
+			return {"url": url, "remote": remote}
+		if remote is None:
+			# The server can not be reached: assume it is unchanged
+			remote = record["signature"].get("remote")
+		elif record["signature"].get("remote") is None:
+			# The version was unknown when the file was downloaded (offline or from a
+			# mirror without ETag/Last-Modified): not a change, record this version to
+			# compare the next time
+			record["signature"].update(url=url, remote=remote)
+			if not dry_run:
+				manifest.save()
+		return {"url": url, "remote": remote}
+
+	def _run_stage(self, manifest, stage, depends, signature, outputs, run, dry_run):
+		"""Run one stage of download_all() if it is not up to date.
+
+		Args:
+			manifest: BuildManifest.
+			stage: Stage name.
+			depends: Stage names whose outputs are inputs of this stage.
+			signature: A function which returns the signature of the stage.
+			outputs: Output files of the stage.
+			run: A function which runs the stage.
+			dry_run: Only report if the stage would be run.
+		"""
+		if self._check_stage(manifest, stage, depends, signature, outputs, dry_run) and not dry_run:
+			with instrument.stage(stage):
+				run()
+			self._record_stage(manifest, stage, signature, outputs)
+
+	def _check_stage(self, manifest, stage, depends, signature, outputs, dry_run):
+		"""Return True if stage must be run, and add it to the plan."""
+		planned = [s for s, reason in self._plan]
+		upstream = [s for s in depends if s in planned]
+		if dry_run and upstream:
+			# inputs are not built yet
+			reason = f"upstream {', '.join(upstream)}"
 		else:
-			logger.warning(f"{self.base_folder}/DEPrior_gini_g2p.txt" + ' already exists. Skip preprocess.')
-		return 
+			reason = manifest.reason(stage, signature(), outputs)
+
+		if reason is None:
+			if not stage in manifest.stages and not dry_run:
+				logger.info(f"{stage}: adopt existing outputs")
+				manifest.record(stage, signature(), outputs)
+			logger.info(f"{stage} is up to date. Skip.")
+			return False
+
+		logger.info(f"{stage}: {reason}")
+		self._plan.append((stage, reason))
+		return True
+
+	def _record_stage(self, manifest, stage, signature, outputs):
+		"""Record stage after it was run."""
+		missing = [fname for fname in outputs if not os.path.exists(fname)]
+		if missing:
+			raise RuntimeError(f"{stage} failed, missing {missing}. See download.log")
+		# inputs created while running (e.g. ID mapping cache) are included
+		manifest.record(stage, signature(), outputs)
 
 	def marge_all(self):
 		"""Loading resources and merge to df.
@@ -131,18 +285,40 @@ class ResourceManager(object):
 		DEPrior_g2p = pd.merge(DEPrior_g2p, gini, 
 			  on=["entrezgene_id", "ensembl_gene_id", "hgnc_symbol"], how="outer")
 
+		# A gini output of an older release has no specificity metrics, the reference is built without them
+		metrics = [c for c in gini_prepare.SPECIFICITY_METRICS if c in gini.columns]
+		if len(metrics) < len(gini_prepare.SPECIFICITY_METRICS):
+			logger.warning(f"{self.resource_folder}/rna_tissue_gtex_gini_norm.tsv has no "
+				  f"{[c for c in gini_prepare.SPECIFICITY_METRICS if not c in metrics]}. "
+				  "Delete it and run data_prep.py again to add them to the reference")
+		specificities = [c for c in reference.SPECIFICITY_COLUMNS if c in DEPrior_g2p.columns]
 
-		DEPrior_g2p.dropna(inplace=True)
+		# Specificity metrics are NaN for genes without expression, those genes are kept
+		DEPrior_g2p.dropna(subset=[c for c in DEPrior_g2p.columns if not c in gini_prepare.SPECIFICITY_METRICS], inplace=True)
+		instrument.count(rows_out=len(DEPrior_g2p))
 
-		# QuantileTransformer on gene2pubmed (uniform distribution: 0 to 1)
+		# Quantile rank of gene2pubmed and normalized Gini index (uniform distribution: 0 to 1)
 		# Only gene in the gene in reference matrix
-		qt = QuantileTransformer()
-		X = np.array(DEPrior_g2p["N"].values).reshape(-1,1)
-		DEPrior_g2p["g2p_rank"] =qt.fit_transform(X)
-
-		# QuantileTransformer on normalized Gini index (uniform distribution: 0 to 1)
-		X = np.array(DEPrior_g2p["gini_norm"].values).reshape(-1,1)
-		DEPrior_g2p["gini_norm_rank"] =qt.fit_transform(X)
+		if self.quantiles is None:
+			transforms = {column: quantile.QuantileRank(self.ties).fit(DEPrior_g2p[column].to_numpy())
+				 for column in ["N", "gini_norm"]}
+			quantile.save(self._quantiles_path(), transforms)
+		else:
+			# Breakpoints of a previous build, new values are interpolated
+			transforms = quantile.load(self.quantiles)
+		DEPrior_g2p["g2p_rank"] = transforms["N"].transform(DEPrior_g2p["N"].to_numpy())
+		DEPrior_g2p["gini_norm_rank"] = transforms["gini_norm"].transform(DEPrior_g2p["gini_norm"].to_numpy())
+
+		# Scores which do not depend on FDR (Glint, rareness and g2p_rank_inv, not those of plugins)
+		# are per-gene constants, precomputed for each specificity column.
+		# Clover.Rank reads them and calculates only the FDR terms.
+		for specificity in specificities:
+			precomputed = reference.precomputed_columns(specificity)
+			names = list(precomputed)
+			columns = {c: DEPrior_g2p[specificity if c == "specificity" else c].to_numpy() for c in scores.inputs(names)}
+			values = scores.evaluate(columns, names, engine="numpy")
+			for name, column in precomputed.items():
+				DEPrior_g2p[column] = values[name]
 
 		# Set data type
 		# DEPrior_g2p = DEPrior_g2p.astype({'entrezgene_id': str})
@@ -152,11 +328,24 @@ class ResourceManager(object):
 				'hgnc_symbol', 'entrezgene_id', 'ensembl_gene_id',
 				'DE_Prior_Rank', 'N', 'g2p_rank',
 				'gini', 'gini_norm', 'gini_norm_rank'
-			]
+			] + metrics + self._precomputed(specificities)
 		)
+
+		# Binary copy for fast loading in Clover.Rank
+		reference.write_binary(f"{self.base_folder}/DEPrior_gini_g2p.txt")
 		
 		return DEPrior_g2p
 
+	def _precomputed(self, specificities=reference.SPECIFICITY_COLUMNS):
+		"""Return the precomputed score columns of the reference (see reference.precomputed_columns())."""
+		columns = []
+		for specificity in specificities:
+			columns += [c for c in reference.precomputed_columns(specificity).values() if not c in columns]
+		return columns
+
+	def _quantiles_path(self):
+		return os.path.join(self.base_folder, 'DEPrior_gini_g2p_quantiles.json')
+
 	def _get_resource_folder(self):
 		resource_dir = os.path.join(self.base_folder, 'resources')
 		if not os.path.isdir(resource_dir):
@@ -167,35 +356,6 @@ class ResourceManager(object):
 		return resource_dir
  
 
-def download_url(url, fname):
-	try:
-		logger.info('Downloading %s into %s' % (url, fname))
-		urllib.request.urlretrieve(url, fname)
-	except Exception as e:
-		logger.error('Download ERROR: %s' % (e))
-
-
-def download_gzip(url, fname):
-	try:
-		logger.info('Downloading %s and extracting into %s' % (url, fname))
-		gz_file = fname + ".gz"
-		urllib.request.urlretrieve(url, gz_file)
-		with gzip.open(gz_file, 'rb') as fin:
-			with open(fname, 'wb') as fout:
-				shutil.copyfileobj(fin, fout)
-	except Exception as e:
-		logger.error('Download ERROR: %s' % (e))
-		
-def download_zip(url, fname):
-	try:
-		logger.info('Downloading %s and extracting into %s' % (url, fname))
-		zfile = fname + ".zip"
-		urllib.request.urlretrieve(url, zfile)
-		with ZipFile(zfile, "r") as f:
-			f.extractall(path=os.path.dirname(fname))
-	except Exception as e:
-		logger.error('Download ERROR: %s' % (e))
-
 if __name__ == '__main__':
 	# Download all the resources if this script is run directly
 	parser = argparse.ArgumentParser(description='Download resources. Data will located in data folder in current directory.')
@@ -203,6 +363,48 @@ if __name__ == '__main__':
                     type=int,
                     default=1,
                     help="thread number to rum gini_prepare.main() parallel")
+	parser.add_argument("--gini_backend",
+                    type=str,
+                    choices=gini_prepare.BACKENDS,
+                    default="threads",
+                    help="run the --thread workers of gini_prepare.main() as threads, processes or serial")
+	parser.add_argument("--refresh_mappings",
+                    action="store_true",
+                    help="download ID mapping from biomart again instead of using the cache")
+	parser.add_argument("--dry_run",
+                    action="store_true",
+                    help="only report which stages would be rebuilt")
+	parser.add_argument("--mirror",
+                    type=str,
+                    default=None,
+                    help="base URL or local folder to download the resources from. Default is $CLOVER_MIRROR")
+	parser.add_argument("--checksums",
+                    type=str,
+                    default=None,
+                    help="sha256sum file to check the downloaded resources")
+	parser.add_argument("--quantiles",
+                    type=str,
+                    default=None,
+                    help="quantile breakpoints of a previous build (DEPrior_gini_g2p_quantiles.json) to map g2p_rank and gini_norm_rank without fitting")
+	parser.add_argument("--ties",
+                    type=str,
+                    choices=quantile.TIES,
+                    default="sklearn",
+                    help="rank of tied values in g2p_rank and gini_norm_rank")
+	parser.add_argument("--metrics",
+                    type=str,
+                    default=None,
+                    help="write the time, memory and row counts of each stage to this JSON file. Default is $CLOVER_METRICS")
+	parser.add_argument("--profile",
+                    type=str,
+                    default=None,
+                    help="run under cProfile and write the stats to this file. Default is $CLOVER_PROFILE")
 	args = parser.parse_args()
-	
-	ResourceManager(args.thread).download_all()
+
+	checksums = download.read_checksums(args.checksums) if args.checksums else None
+	with instrument.session(args.metrics, args.profile):
+		if args.refresh_mappings and not args.dry_run:
+			convert.load_mapping_data(refresh=True)
+		plan = ResourceManager(args.thread, args.mirror, checksums, args.quantiles, args.ties, args.gini_backend).download_all(args.dry_run)
+	for stage, reason in plan:
+		print(f"{'would run' if args.dry_run else 'ran'} {stage}: {reason}")
@@ -0,0 +1,186 @@
+# Download of the resource files.
+#
+# A file is downloaded into <file>.part and renamed when it is complete, so
+# an interrupted download never leaves a truncated file behind. The next
+# attempt resumes the .part file with an HTTP Range request (servers without
+# range support send the whole file again). The ETag or Last-Modified of the
+# .part is kept in <file>.part.version and sent as If-Range, so that a .part
+# of an older version of the file is downloaded again, not resumed.
+# A downloaded file is checked before it is renamed: the length against
+# Content-Length, the sha256 if it is known, and gzip/zip files are read
+# through to check their CRC.
+#
+# Set CLOVER_MIRROR (or data_prep.py --mirror) to download from a mirror
+# instead of the original URLs, e.g. a local folder on an offline node.
+# Files are looked up by file name under the mirror.
+
+import os
+import time
+import gzip
+import shutil
+import hashlib
+import pathlib
+import urllib.error
+import urllib.request
+from zipfile import ZipFile, BadZipFile
+
+import logging
+logger = logging.getLogger(__name__)
+
+MIRROR_ENV = "CLOVER_MIRROR"
+
+# Bytes read at once
+BLOCK_SIZE = 1 << 20
+
+def mirror_url(url, fname, mirror=None):
+	"""Return the URL of fname, on the mirror if one is set.
+
+	Args:
+		url: The original URL.
+		fname: A file name of the download.
+		mirror: A base URL or a local folder. The default is $CLOVER_MIRROR.
+	"""
+	if mirror is None:
+		mirror = os.environ.get(MIRROR_ENV)
+	if not mirror:
+		return url
+	if not "://" in mirror:
+		mirror = pathlib.Path(mirror).resolve().as_uri()
+	return f"{mirror.rstrip('/')}/{os.path.basename(fname)}"
+
+def read_checksums(checksum_file):
+	"""Read a checksum file in the format of `sha256sum` ("<sha256>  <file name>").
+
+	Returns:
+		Dictionary of file name to sha256.
+	"""
+	checksums = {}
+	with open(checksum_file) as f:
+		for line in f:
+			if line.strip():
+				sha256, name = line.split(maxsplit=1)
+				checksums[os.path.basename(name.strip().lstrip("*"))] = sha256.lower()
+	return checksums
+
+def sha256sum(fname):
+	h = hashlib.sha256()
+	with open(fname, "rb") as f:
+		for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+			h.update(block)
+	return h.hexdigest()
+
+def check_file(fname, name, sha256=None):
+	"""Check a downloaded file.
+
+	Args:
+		fname: A path of the downloaded file.
+		name: The file name of the download, gzip and zip are checked by the extension.
+		sha256: The expected sha256, not checked if None.
+
+	Raises:
+		ValueError: An error occurs when the file is corrupted.
+	"""
+	if sha256 is not None:
+		actual = sha256sum(fname)
+		if actual != sha256:
+			raise ValueError(f"{name}: sha256 {actual} does not match {sha256}")
+	try:
+		if name.endswith(".gz"):
+			with gzip.open(fname, "rb") as f:
+				while f.read(BLOCK_SIZE):
+					pass
+		elif name.endswith(".zip"):
+			with ZipFile(fname) as f:
+				bad = f.testzip()
+			if bad is not None:
+				raise ValueError(f"{name}: {bad} is corrupted")
+	except (OSError, EOFError, BadZipFile) as e:
+		raise ValueError(f"{name} is corrupted: {e}")
+
+def _validator(headers):
+	"""Return the ETag (if strong) or Last-Modified of a response, None if neither is sent."""
+	etag = headers.get("ETag")
+	if etag and not etag.startswith("W/"):
+		return etag
+	return headers.get("Last-Modified")
+
+def _remove_part(part):
+	for fname in [part, part + ".version"]:
+		if os.path.exists(fname):
+			os.remove(fname)
+
+def _fetch(url, part, timeout):
+	"""Download url into part, resume if part exists and is of the same version."""
+	version_file = part + ".version"
+	version = None
+	if os.path.exists(part) and os.path.exists(version_file):
+		with open(version_file) as f:
+			version = f.read().strip() or None
+	if version is None:
+		# The version of part is unknown, it can not be resumed safely
+		_remove_part(part)
+	start = os.path.getsize(part) if os.path.exists(part) else 0
+	request = urllib.request.Request(url)
+	if start:
+		request.add_header("Range", f"bytes={start}-")
+		# The server sends the whole file if it changed since part was started
+		request.add_header("If-Range", version)
+	try:
+		response = urllib.request.urlopen(request, timeout=timeout)
+	except urllib.error.HTTPError as e:
+		if start and e.code == 416:
+			# part is already complete
+			return
+		raise
+
+	with response:
+		if start and getattr(response, "status", None) != 206:
+			logger.info(f"{url} changed or does not support resume, download from the beginning")
+			start = 0
+		elif start:
+			logger.info(f"Resume {url} from {start} bytes")
+		length = response.headers.get("Content-Length")
+		if not start:
+			# part is written from the beginning, recorded with its version
+			_remove_part(part)
+			version = _validator(response.headers)
+			if version is not None:
+				with open(version_file, "w") as f:
+					f.write(version)
+		with open(part, "ab" if start else "wb") as f:
+			shutil.copyfileobj(response, f, BLOCK_SIZE)
+
+	if length is not None and os.path.getsize(part) != start + int(length):
+		raise IOError(f"{url}: incomplete download, {os.path.getsize(part)} of {start + int(length)} bytes")
+
+def download(url, fname, sha256=None, retries=3, timeout=60):
+	"""Download url into fname.
+
+	Args:
+		url: URL to download, http(s), ftp or file.
+		fname: A path to save.
+		sha256: The expected sha256 of the file, not checked if None.
+		retries: Number of attempts. An interrupted download is resumed.
+		timeout: Timeout of the connection in seconds.
+
+	Raises:
+		IOError or ValueError if the file can not be downloaded or is corrupted.
+	"""
+	part = fname + ".part"
+	for attempt in range(1, retries + 1):
+		try:
+			logger.info(f"Downloading {url} into {fname}")
+			_fetch(url, part, timeout)
+			check_file(part, fname, sha256)
+			os.replace(part, fname)
+			_remove_part(part)
+			logger.info(f"Downloaded {fname}")
+			return fname
+		except (OSError, ValueError) as e:
+			logger.warning(f"Download {url} failed ({attempt}/{retries}): {e}")
+			if isinstance(e, ValueError):
+				# A corrupted file is not resumed
+				_remove_part(part)
+			if attempt == retries:
+				raise
+			time.sleep(attempt)
@@ -1,24 +1,64 @@
 # Extruct human gene publication count.
 # Sorse data is from NCBI
 # https://ftp.ncbi.nlm.nih.gov/gene/DATA/gene2pubmed.gz
+#
+# gene2pubmed has all taxa. It is read in chunks, gzip compressed or not,
+# and only the count of human rows per GeneID is kept in memory.
 
 import pathlib
 import pandas as pd
 
 from convert import add_ids
+import instrument
 
 tax_id = 9606 # human
 
+# rows per chunk of gene2pubmed
+chunksize = 1000000
+
 def get_human(file):
 	all_g2p = pd.read_csv(file, sep="\t", header=None, skiprows=1, 
 							names = ["tax_id", "GeneID", "PubMed_ID"])
 	human_g2p = all_g2p[all_g2p["tax_id"]==9606]
 	return human_g2p
 
+def count_human(file, chunksize=chunksize):
+	"""Count publications of each human gene in gene2pubmed.
+
+	Same as get_human(file).groupby(["GeneID"]).size(), but the file is
+	streamed in chunks. Peak memory is bounded by the chunk size and the
+	number of human genes, not by the file size.
+
+	Args:
+		file: gene2pubmed file, .gz is decompressed while reading.
+		chunksize: Number of rows per chunk.
+
+	Returns:
+		pandas.DataFrame of GeneID and N (number of publications), sorted by GeneID.
+	"""
+	counts = None
+	reader = pd.read_csv(file, sep="\t", header=None, skiprows=1,
+						names = ["tax_id", "GeneID"], usecols=[0, 1],
+						dtype="int64", chunksize=chunksize)
+	for chunk in reader:
+		human = chunk.loc[chunk["tax_id"]==tax_id, "GeneID"]
+		instrument.count(rows_in=len(chunk), human_rows=len(human))
+		chunk_counts = human.value_counts(sort=False)
+		if counts is None:
+			counts = chunk_counts
+		else:
+			counts = counts.add(chunk_counts, fill_value=0)
+
+	if counts is None:
+		counts = pd.Series(dtype="int64")
+	counts = counts.astype("int64").sort_index()
+	counts.index.name = "GeneID"
+	return counts.reset_index(name='N')
+
 def main(file):
-	g2p = get_human(file)
-	g2p_size = g2p.groupby(["GeneID"]).size().reset_index(name='N')
+	g2p_size = count_human(file)
 
+	# gene2pubmed.gz -> gene2pubmed_human_count.txt
 	p_file = pathlib.Path(file)
 	g2p_size = add_ids(g2p_size,entrezgene_id = "GeneID")
 	g2p_size.to_csv(f"{p_file.parent}/{p_file.stem}_human_count.txt", sep="\t",index=False)
@@ -26,4 +66,4 @@ def main(file):
 
 # if __name__ == '__main__':
 # 	file = "/home/oba/TF_Rank_Across_Cells/git/notebooks_src/src/Tresure_hunter_20230207/tests/resources/test_g2p"
-# 	main(file)
\ No newline at end of file
+# 	main(file)
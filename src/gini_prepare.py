@@ -3,19 +3,45 @@
 # Get the Gini index on genes as a matrix
 # Sorse RNA-seq data is from GTEx data in Human Protein Atlas
 # https://www.proteinatlas.org/about/download
+#
+# Other tissue specificity metrics are calculated in the same pass (nTPM, NaN skipped),
+# see Kryuchkova-Mostacci and Robinson-Rechavi, Brief Bioinform 2017:
+#   tau: sum(1 - x / max(x)) / (N - 1). 0: housekeeping, 1: specific.
+#   tsi: max(x) / sum(x). 1/N: housekeeping, 1: specific.
+#   entropy: Shannon entropy of x / sum(x) in bits. log2(N): housekeeping, 0: specific.
+#   entropy_norm: 1 - entropy / log2(N). 0: housekeeping, 1: specific.
+#   q: Q statistic of the tissue of max, entropy - log2(tsi). Low: specific.
+#   tissue_max: Tissue of max(x).
 
 # output matrix has 19764 gene
 
 import pathlib
-import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from multiprocessing import Pool
+from pandas.api.types import union_categoricals
 
 import logging
 logger = logging.getLogger(__name__)
 
 from convert import add_ids
+import instrument
+
+# Columns of the GTEx file used to calculate Gini index, the others (TPM, pTPM) are not read
+COLUMNS = ["Gene", "Gene name", "Tissue", "nTPM"]
+
+# Parallel backends of gini_rows()
+BACKENDS = ["serial", "threads", "processes"]
+
+# Row blocks per worker, so that workers finish at about the same time
+BLOCKS_PER_WORKER = 4
+
+# Rows of the output of gini_block(), the slot is the position of max(x) in the row of values
+BLOCK_METRICS = ["gini", "expression_mean", "tau", "tsi", "entropy", "entropy_norm", "q", "slot_max"]
+
+# Tissue specificity columns of the output (rna_tissue_gtex_gini_norm.tsv), besides gini and gini_norm
+SPECIFICITY_METRICS = ["tau", "tsi", "entropy", "entropy_norm", "q", "tissue_max"]
 
 def gini_fast(array):
 	""" Calculate the Gini index
@@ -49,9 +75,164 @@ def gini_fast(array):
 
 	return gini
 
+def gini_matrix(matrix):
+	""" Calculate the Gini index of every row of a matrix at once
+
+	Row-wise version of gini_fast(). Each row is one gene and every value in
+	the row is used, so genes must be grouped by their number of values before
+	calling this function (see gini_rows()).
+
+	Args:
+		matrix: A 2-D numpy array of expression values (genes x values).
+
+	Returns:
+		gini: numpy array of Gini index per row.
+	"""
+	matrix = np.array(matrix, dtype=float)
+	matrix -= np.amin(matrix, axis=1, keepdims=True)
+	matrix += 0.0000001
+	matrix = np.sort(matrix, axis=1)
+	n = matrix.shape[1]
+	index = np.arange(1,n+1)
+
+	gini = np.sum((2 * index - (n + 1)) * matrix, axis=1) / (n * np.sum(matrix, axis=1))
+
+	return gini
+
+def gini_block(values, sizes, out, start, stop):
+	""" Calculate Gini index, mean and the specificity metrics of the genes start:stop into out
+
+	Args:
+		values: A 2-D numpy array (genes x tissues), see gini_rows().
+		sizes: numpy array of the number of expression values per gene.
+		out: A 2-D float64 numpy array (BLOCK_METRICS x genes) to write the
+			metrics in the order of BLOCK_METRICS.
+		start, stop: Rows of values to calculate.
+	"""
+	block_sizes = sizes[start:stop]
+	# Rows which have the same number of values are one dense block
+	for n in np.unique(block_sizes):
+		rows = start + np.flatnonzero(block_sizes == n)
+		# float64 sums, values may be float32
+		block = values[rows, :n].astype(float)
+		out[0, rows] = gini_matrix(block)
+
+		# Same as pandas.Series.mean(): skip NaN
+		missing = np.isnan(block)
+		x = np.where(missing, 0, block)
+		valid = n - missing.sum(axis=1)
+		total = x.sum(axis=1)
+		out[1, rows] = total / valid
+
+		masked = np.where(missing, -np.inf, block)
+		slot_max = masked.argmax(axis=1)
+		x_max = masked[np.arange(len(rows)), slot_max]
+		# genes without expression (or one value) have no specificity
+		expressed = (x_max > 0) & (valid > 1)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			tsi = x_max / total
+			p = x / total[:, None]
+			# + 0.0: a gene expressed in one tissue has entropy 0.0, not -0.0
+			entropy = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1) + 0.0
+			out[2, rows] = np.where(expressed, (valid - total / x_max) / (valid - 1), np.nan)
+			out[3, rows] = np.where(expressed, tsi, np.nan)
+			out[4, rows] = np.where(expressed, entropy, np.nan)
+			out[5, rows] = np.where(expressed, 1 - entropy / np.log2(valid), np.nan)
+			out[6, rows] = np.where(expressed, entropy - np.log2(tsi), np.nan)
+		out[7, rows] = np.where(expressed, slot_max, -1)
+
+# Shared by the gini worker processes, set by _init_gini()
+_gini_arrays = None
+
+def _init_gini(values, shape, dtype, sizes, out):
+	global _gini_arrays
+	_gini_arrays = (np.frombuffer(values, dtype=dtype).reshape(shape),
+				 np.frombuffer(sizes, dtype=np.int64),
+				 np.frombuffer(out, dtype=np.float64).reshape(len(BLOCK_METRICS), -1))
+
+def _gini_block_shared(rows):
+	values, sizes, out = _gini_arrays
+	gini_block(values, sizes, out, *rows)
+
+def _shared_array(array):
+	""" Return a copy of a numpy array in shared memory (multiprocessing.RawArray) """
+	shared = multiprocessing.RawArray(np.ctypeslib.as_ctypes_type(array.dtype), array.size)
+	np.frombuffer(shared, dtype=array.dtype).reshape(array.shape)[...] = array
+	return shared
+
+def gini_rows(values, sizes, workers: int = 1, backend: str = "threads"):
+	""" Calculate Gini index, normalized Gini index, mean and specificity metrics of every gene
+
+	The genes are split into contiguous row blocks. Each block is written
+	straight into the output arrays, so workers return nothing.
+
+	Args:
+		values: A 2-D numpy array (genes x tissues). Row i holds sizes[i]
+			expression values on the left, the rest is padding.
+		sizes: numpy array of the number of expression values per gene.
+		workers: Number of threads or processes. None is 1.
+		backend: One of BACKENDS.
+			serial: one block in this thread.
+			threads: blocks in threads. numpy sorts and sums release the GIL,
+				and the arrays are shared without copies.
+			processes: blocks in processes. values, sizes and the outputs are
+				copied once to shared memory, not pickled per task.
+
+	Returns:
+		Dictionary of numpy arrays:
+			gini: Gini index. Max is 1 - 1/N. (N is tissue size)
+			gini_norm: Normalized Gini index. Normalize by (N/(N-1)). Max is 1.
+			expression_mean: Expression mean amoung tissue (NaN are skipped).
+			tau, tsi, entropy, entropy_norm, q: see the top of this file.
+			slot_max: Position of max in the row of values, -1 for genes without expression.
+	"""
+	if not (backend in BACKENDS):
+		raise ValueError("Invalid backend. Expected one of: %s" % BACKENDS)
+	sizes = np.asarray(sizes, dtype=np.int64)
+	n_genes = len(sizes)
+	if not workers or workers <= 1 or n_genes == 0:
+		backend = "serial"
+
+	n_blocks = 1 if backend == "serial" else min(n_genes, workers * BLOCKS_PER_WORKER)
+	bounds = np.linspace(0, n_genes, n_blocks + 1).astype(int)
+	blocks = list(zip(bounds[:-1], bounds[1:]))
+
+	if backend == "processes":
+		shared_out = multiprocessing.RawArray("d", len(BLOCK_METRICS) * n_genes)
+		initargs = (_shared_array(values), values.shape, values.dtype, _shared_array(sizes), shared_out)
+		with multiprocessing.Pool(workers, initializer=_init_gini, initargs=initargs) as p:
+			p.map(_gini_block_shared, blocks, chunksize=1)
+		out = np.frombuffer(shared_out, dtype=np.float64).reshape(len(BLOCK_METRICS), n_genes)
+	else:
+		out = np.full((len(BLOCK_METRICS), n_genes), np.nan)
+		if backend == "threads":
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				# list() raises the error of a block
+				list(executor.map(lambda rows: gini_block(values, sizes, out, *rows), blocks))
+		else:
+			gini_block(values, sizes, out, 0, n_genes)
+
+	metrics = {metric: out[i].copy() for i, metric in enumerate(BLOCK_METRICS)}
+	metrics["gini_norm"] = metrics["gini"] * (sizes/(sizes-1))
+	metrics["slot_max"] = metrics["slot_max"].astype(np.int64)
+	return metrics
+
+def _factorize(column):
+	""" Return the codes (-1 for NaN) and the sorted unique values of a column """
+	if isinstance(column.dtype, pd.CategoricalDtype):
+		# codes into the sorted categories (see GetGini.read_file())
+		column = column.cat.remove_unused_categories()
+		return column.cat.codes.to_numpy(), pd.Index(column.cat.categories)
+	codes, uniques = pd.factorize(column, sort=True)
+	return codes, pd.Index(uniques)
+
 class GetGini(object):
 	""" Calculate Gini index
 
+	Only Gene, Gene name, Tissue and nTPM are read. Gene, Gene name and
+	Tissue are categorical (codes into the unique values), so the table
+	does not hold one Python string per row.
+
 	Args: 
 		file: GTEx RNA-seq file name. A column name in the matrix is as below:
 				column0: Gene
@@ -60,10 +241,19 @@ class GetGini(object):
 				column3: TPM
 				column4: pTPM
 				column5: nTPM
+		dtype: dtype of nTPM. float32 halves the expression values, Gini index
+			is summed in float64 either way. Set float64 to read nTPM exactly.
+		chunksize: Read the file in chunks of this number of rows to lower the
+			peak memory of parsing. The default reads it at once.
+		engine: CSV parser of pandas.read_csv(), "c" or "pyarrow" (needs pyarrow,
+			faster on large files). chunksize is not supported by pyarrow.
 	"""
-	def __init__(self, file: str):
+	def __init__(self, file: str, dtype = np.float32, chunksize: int = None, engine: str = "c"):
 
 		self.file = file
+		self.dtype = dtype
+		self.chunksize = chunksize
+		self.engine = engine
 		self.expression_matrix = self.read_file()
 		self.type = "Tissue" # Column name to group
 		self.expression_column = "nTPM" # Column name of expression value
@@ -73,18 +263,35 @@ class GetGini(object):
 		""" Read GTEx RNA-seq expression from HPA
 		
 		Returns:
-			pandas.DataFrame of read file.
+			pandas.DataFrame of Gene, Gene name, Tissue (categorical) and nTPM.
 		
 		Raises:
 			FileNotFoundError: An error occurs when the input file does not exist.
+			ValueError: chunksize is set with the pyarrow engine.
 
 		"""
+		if self.chunksize is not None and self.engine == "pyarrow":
+			raise ValueError("chunksize is not supported by the pyarrow engine")
+		dtype = {"Gene": "category", "Gene name": "category", "Tissue": "category", "nTPM": self.dtype}
 		try:
-			df = pd.read_csv(self.file, sep="\t", 
-						dtype={0: str, 1: str, 2: str, 3: float, 4: float, 5: float},
-						encoding="utf-8")
+			if self.chunksize is None:
+				df = pd.read_csv(self.file, sep="\t", usecols=COLUMNS, dtype=dtype,
+							encoding="utf-8", engine=self.engine)
+			else:
+				chunks = list(pd.read_csv(self.file, sep="\t", usecols=COLUMNS, dtype=dtype,
+							encoding="utf-8", chunksize=self.chunksize))
+				# categories differ between chunks
+				df = pd.DataFrame({
+					column: union_categoricals([chunk[column] for chunk in chunks])
+						if column != "nTPM" else np.concatenate([chunk[column].to_numpy() for chunk in chunks])
+					for column in COLUMNS})
+			# sorted categories, so that genes are sorted by name as before (see expression_array())
+			# pyarrow reads empty fields as "", the C parser as NaN
+			for column in ["Gene", "Gene name", "Tissue"]:
+				categories = df[column].cat.categories
+				df[column] = df[column].cat.set_categories(categories[categories != ""].sort_values())
 			logger.info(f"Loaded: {self.file}")
-			return df
+			return df[COLUMNS]
 
 		except FileNotFoundError as e:
 			logger.info(f"FileNotFoundError: {e}")
@@ -130,28 +337,93 @@ class GetGini(object):
 
 		return gene_name.unique()[0], gini, g_norm, expression_mean
 
-def main(input_file, thread):
-	get_Gini = GetGini(input_file)
-	uniq_gene = get_Gini.genes()
+	def expression_array(self):
+		""" Pivot the long expression table to a dense gene x tissue array
+
+		The table is grouped by gene once. Values of a gene keep the order of
+		the input file and are packed to the left of the row, the rest of the
+		row is NaN.
+
+		Returns:
+			genes: pandas.Index of the genes (sorted, same as genes()).
+			gene_name: numpy array of the first gene name of each gene.
+			values: 2-D numpy array of expression values (genes x tissues),
+				in the dtype of nTPM.
+			sizes: numpy array of the number of tissues of each gene.
+			tissue: 2-D numpy array of the codes into tissues of each value, -1 in padding.
+			tissues: pandas.Index of the tissues.
+		"""
+		df = self.expression_matrix
+		gene_codes, genes = _factorize(df["Gene"])
+		tissue_codes, tissues = _factorize(df[self.type])
+
+		# rows without gene (code -1) are sorted first, they are ignored like groupby()
+		order = np.argsort(gene_codes, kind="stable")
+		order = order[np.count_nonzero(gene_codes < 0):]
+		gene_codes = gene_codes[order]
+
+		sizes = np.bincount(gene_codes, minlength=len(genes))
+		starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+		slot = np.arange(len(order)) - starts[gene_codes]
 
+		expression = df[self.expression_column].to_numpy()
+		values = np.full((len(genes), sizes.max(initial=0)), np.nan, dtype=expression.dtype)
+		values[gene_codes, slot] = expression[order]
+		tissue = np.full(values.shape, -1, dtype=tissue_codes.dtype)
+		tissue[gene_codes, slot] = tissue_codes[order]
+		# names of the first rows only, without converting the whole column
+		gene_name = np.asarray(df[self.name_column].iloc[order[starts]], dtype=object)
+
+		return genes, gene_name, values, sizes, tissue, tissues
+
+	def calculate_gini_all(self, workers: int = 1, backend: str = "threads"):
+		""" Calculate gini of all genes in one pass
+
+		Vectorized version of calculate_gini() over genes().
+
+		Args:
+			workers: Number of threads or processes (see gini_rows()).
+			backend: One of BACKENDS.
+
+		Returns:
+			pandas.DataFrame with Ensembl ID, Gene name, gini, gini_norm and expression_mean.
+		"""
+		genes, gene_name, values, sizes, tissue, tissues = self.expression_array()
+
+		# remove genes which only have one tissue data in a matrix.
+		use = sizes > 1
+		logger.info(f"Number of genes: {use.sum()}")
+		metrics = gini_rows(values[use], sizes[use], workers, backend)
+
+		# tissue of the max value of each gene
+		slot_max = metrics.pop("slot_max")
+		tissue_codes = tissue[use][np.arange(len(slot_max)), slot_max]
+		tissue_max = np.asarray(tissues, dtype=object).take(tissue_codes, mode="clip")
+		tissue_max[(slot_max < 0) | (tissue_codes < 0)] = np.nan
+
+		result = pd.DataFrame({
+			'Ensembl ID': genes[use],
+			'Gene name': gene_name[use],
+			'gini': metrics["gini"],
+			"gini_norm" : metrics["gini_norm"],
+			'expression_mean': metrics["expression_mean"]})
+		for metric in SPECIFICITY_METRICS:
+			result[metric] = tissue_max if metric == "tissue_max" else metrics[metric]
+		return result
+
+def main(input_file, thread, dtype = np.float32, chunksize: int = None, engine: str = "c", backend: str = "threads"):
 	if thread is None:
 		thread = 1
-	
-	with Pool(thread) as p:
-		result = p.map(functools.partial(get_Gini.calculate_gini),uniq_gene)
-	gene_name = [i[0] for i in result]
-	gini = [i[1] for i in result]
-	gini_norm = [i[2] for i in result]
-	expression_mean = [i[3] for i in result]
-
-	result = pd.DataFrame({
-			'Ensembl ID': uniq_gene,
-			'Gene name': gene_name,
-			'gini': gini,
-			"gini_norm" : gini_norm,
-			'expression_mean': expression_mean})
+	get_Gini = GetGini(input_file, dtype, chunksize, engine)
+
+	# Blocks of genes are calculated by thread workers
+	result = get_Gini.calculate_gini_all(thread, backend)
+	instrument.count(rows_in=len(get_Gini.expression_matrix), genes_out=len(result))
 
 	p_file = pathlib.Path(input_file)
+	if p_file.suffix == ".zip":
+		# rna_tissue_gtex.tsv.zip is read without extracting
+		p_file = p_file.with_suffix("")
 	result = add_ids(result,hgnc_symbol = "Gene name", ensembl_gene_id = "Ensembl ID")
 	result.to_csv(f"{p_file.parent}/{p_file.stem}_gini_norm.tsv", sep="\t",index=False)
 
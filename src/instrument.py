@@ -0,0 +1,117 @@
+# Stage timing and memory of Clover runs.
+#
+# Code marks its stages with `with instrument.stage("name"):` and adds row
+# counts with instrument.count(rows_in=...). Nothing is measured unless a
+# session is enabled, by --metrics / --profile of Clover.py and data_prep.py
+# or by CLOVER_METRICS / CLOVER_PROFILE (file paths).
+#
+# Stages are nested, a stage inside "rank" is named "rank/<name>". A stage
+# run several times (e.g. once per chunk) is summed. For each stage the
+# JSON has: calls, wall_s, cpu_s, peak_rss_mb (peak RSS of the process at
+# the end of the stage) and the counts. Each finished stage is also logged
+# as one JSON line.
+# With a profile file, the whole session runs under cProfile and the stats
+# are written for `python -m pstats` or snakeviz.
+
+import os
+import sys
+import json
+import time
+import cProfile
+import contextlib
+
+try:
+	import resource
+except ImportError:
+	# Windows
+	resource = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+METRICS_ENV = "CLOVER_METRICS"
+PROFILE_ENV = "CLOVER_PROFILE"
+
+# Set by session()
+_stages = None
+_stack = []
+
+def enabled():
+	return _stages is not None
+
+def peak_rss_mb():
+	"""Return the peak resident set size of this process in MB, None if unknown."""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# bytes on macOS, kilobytes on Linux
+	return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+@contextlib.contextmanager
+def stage(name):
+	"""Measure a stage, a no-op if no session is enabled."""
+	if _stages is None:
+		yield
+		return
+
+	_stack.append({"name": "/".join([s["name"] for s in _stack[-1:]] + [name]), "counts": {}})
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	try:
+		yield
+	finally:
+		current = _stack.pop()
+		record = _stages.setdefault(current["name"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+		record["calls"] += 1
+		record["wall_s"] += time.perf_counter() - wall
+		record["cpu_s"] += time.process_time() - cpu
+		record["peak_rss_mb"] = peak_rss_mb()
+		for key, value in current["counts"].items():
+			record[key] = record.get(key, 0) + value
+		logger.info(json.dumps(dict(stage=current["name"], **record)))
+
+def count(**counts):
+	"""Add counts (e.g. rows_in=100, unmatched=3) to the current stage."""
+	if _stages is None or not _stack:
+		return
+	stage_counts = _stack[-1]["counts"]
+	for key, value in counts.items():
+		stage_counts[key] = stage_counts.get(key, 0) + int(value)
+
+@contextlib.contextmanager
+def session(metrics_file=None, profile_file=None):
+	"""Enable the instrumentation while the block runs.
+
+	Args:
+		metrics_file: A JSON file to write the stages. The default is $CLOVER_METRICS.
+		profile_file: A file to write cProfile stats. The default is $CLOVER_PROFILE.
+	"""
+	global _stages
+	metrics_file = metrics_file or os.environ.get(METRICS_ENV)
+	profile_file = profile_file or os.environ.get(PROFILE_ENV)
+	if metrics_file is None and profile_file is None:
+		yield
+		return
+
+	_stages = {}
+	profiler = cProfile.Profile() if profile_file else None
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	if profiler is not None:
+		profiler.enable()
+	try:
+		yield
+	finally:
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(profile_file)
+			logger.info(f"Saved: {profile_file}")
+		if metrics_file is not None:
+			metrics = {"command": sys.argv,
+					   "total": {"wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu,
+								 "peak_rss_mb": peak_rss_mb()},
+					   "stages": _stages}
+			with open(metrics_file, "w") as f:
+				json.dump(metrics, f, indent=2)
+			logger.info(f"Saved: {metrics_file}")
+		_stages = None
@@ -0,0 +1,115 @@
+# Build manifest of the Clover reference.
+#
+# data_prep.ResourceManager builds the reference in stages:
+# download -> g2p count / gini -> merge.
+# The manifest records, for each stage, a signature of its inputs (content
+# hashes of input files, upstream ETag/Last-Modified and the code version)
+# and its outputs. A stage is run again only if its signature changed or an
+# output is missing.
+
+import os
+import json
+import hashlib
+import urllib.request
+
+import logging
+logger = logging.getLogger(__name__)
+
+src_directory = os.path.dirname(os.path.abspath(__file__))
+
+def code_version(*modules):
+	"""Return a hash of the source files of modules (e.g. "gini_prepare")."""
+	h = hashlib.sha256()
+	for module in modules:
+		with open(os.path.join(src_directory, f"{module}.py"), "rb") as f:
+			h.update(f.read())
+	return h.hexdigest()
+
+def remote_version(url, timeout=30):
+	"""Return ETag and Last-Modified of url, None if the server can not be reached.
+	"""
+	try:
+		request = urllib.request.Request(url, method="HEAD")
+		with urllib.request.urlopen(request, timeout=timeout) as response:
+			return {"etag": response.headers.get("ETag"),
+					"last_modified": response.headers.get("Last-Modified")}
+	except Exception as e:
+		logger.warning('HEAD %s ERROR: %s' % (url, e))
+		return None
+
+class BuildManifest(object):
+	"""Record of the reference build.
+
+	Attributes:
+		path: A path of the manifest JSON file.
+		stages: Dictionary of stage name to {"signature": ..., "outputs": [...]}.
+		files: Dictionary of file path to {"size", "mtime_ns", "sha256"}, to hash
+			a file only if it is changed.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.stages = {}
+		self.files = {}
+		if os.path.exists(path):
+			with open(path) as f:
+				manifest = json.load(f)
+			self.stages = manifest.get("stages", {})
+			self.files = manifest.get("files", {})
+
+	def save(self):
+		with open(self.path, "w") as f:
+			json.dump({"stages": self.stages, "files": self.files}, f, indent=1, sort_keys=True)
+
+	def file_hash(self, fname):
+		"""Return sha256 of fname, reuse the recorded hash if size and mtime are the same."""
+		stat = os.stat(fname)
+		record = self.files.get(fname)
+		if record is not None and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+			return record["sha256"]
+
+		h = hashlib.sha256()
+		with open(fname, "rb") as f:
+			for block in iter(lambda: f.read(1 << 20), b""):
+				h.update(block)
+		self.files[fname] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": h.hexdigest()}
+		return h.hexdigest()
+
+	def signature(self, inputs=(), **values):
+		"""Return the signature of a stage.
+
+		Args:
+			inputs: Input files, hashed by content. Missing files are None.
+			values: Other values of the stage, e.g. code version or remote version.
+		"""
+		signature = {os.path.basename(fname): self.file_hash(fname) if os.path.exists(fname) else None
+				for fname in inputs}
+		signature.update(values)
+		return signature
+
+	def reason(self, stage, signature, outputs):
+		"""Return why stage must be run, None if it is up to date.
+
+		A stage without record whose outputs exist (e.g. built before the
+		manifest was introduced) is up to date and adopted by record(), unless
+		its signature has a code version: the code which wrote the outputs is
+		not known, so the stage is run again.
+		"""
+		missing = [fname for fname in outputs if not os.path.exists(fname)]
+		if missing:
+			return f"missing {', '.join(os.path.basename(fname) for fname in missing)}"
+		record = self.stages.get(stage)
+		if record is None:
+			if "code" in signature:
+				return "unknown code version of existing outputs"
+			return None
+		changed = sorted(key for key in set(signature) | set(record["signature"])
+				   if signature.get(key) != record["signature"].get(key))
+		if changed:
+			return f"changed {', '.join(changed)}"
+		return None
+
+	def record(self, stage, signature, outputs):
+		"""Record that stage was run, or adopted, with signature."""
+		self.stages[stage] = {"signature": signature,
+							  "outputs": {os.path.basename(fname): self.file_hash(fname) for fname in outputs}}
+		self.save()
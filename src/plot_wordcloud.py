@@ -1,10 +1,15 @@
 import os
+import shutil
+import hashlib
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from wordcloud import WordCloud
-from sklearn import preprocessing
+
+from scores import ascending
 
 
 def asc4rank(score):
@@ -13,6 +18,7 @@ def asc4rank(score):
     This rank will reflect the word size in the word cloud.
     So, FDR and Glint will be False, the smaller the value, the larger the word size.
     and the others will be True, the larger the value, the larger the word size.
+    The order of a score is set when it is registered (see scores.register).
 
     Parameters
     ----------
@@ -25,11 +31,35 @@ def asc4rank(score):
         True if the score is in ascending order for ranking.
 
     """
-    asc = ['FDR', 'Glint']
-    if score in asc:
-        return False
-    else:
-        return True
+    return not ascending(score)
+
+def minmax_scale(x, feature_range=(0, 1)):
+    """
+    Scale values to feature_range.
+    Same as sklearn.preprocessing.minmax_scale() for 1-D input, without importing sklearn.
+
+    Parameters
+    ----------
+    x : array-like
+        1-D values. NaN are ignored to find min and max.
+    feature_range : tuple
+        (min, max) of the scaled values.
+
+    Returns
+    -------
+    numpy.ndarray
+        Scaled values.
+    """
+    x = np.array(x, dtype=float)
+    data_min = np.nanmin(x)
+    data_range = np.nanmax(x) - data_min
+    # constant values are not scaled
+    if data_range < 10 * np.finfo(float).eps:
+        data_range = 1.0
+    scale = (feature_range[1] - feature_range[0]) / data_range
+    x *= scale
+    x += feature_range[0] - data_min * scale
+    return x
 
 class FreqColorFunc(object):
     """
@@ -72,6 +102,22 @@ class FreqColorFunc(object):
         return self.c(self.f[word])
     
 
+# WordCloud is configured once per process and reused for every plot
+_wordcloud = None
+
+def get_wordcloud():
+    """
+    Return the WordCloud instance of this process.
+
+    Returns
+    -------
+    WordCloud
+    """
+    global _wordcloud
+    if _wordcloud is None:
+        _wordcloud = WordCloud(background_color="white", width=800, height=600, max_words=1000)
+    return _wordcloud
+
 def plot_wordcloud(result_df, score, output_path, figsize=(10, 3), colormap=plt.get_cmap("viridis")):
     label_offset = 0
 
@@ -84,10 +130,11 @@ def plot_wordcloud(result_df, score, output_path, figsize=(10, 3), colormap=plt.
     
     # Normalize the score values to be between 0.01 and 0.99
     # if 0 - 1, 0 value will be removed from the word cloud
-    df["norm_score"] = preprocessing.minmax_scale(s, feature_range=(0.01,0.99))
+    df["norm_score"] = minmax_scale(s, feature_range=(0.01,0.99))
     
     # create a color function with the colormap
-    cfunc = FreqColorFunc(df.set_index("genename")["norm_score"].to_dict(), colormap)
+    df_gene = df.set_index("genename")
+    cfunc = FreqColorFunc(df_gene["norm_score"].to_dict(), colormap)
 
     # Create a figure with one subplot for the word cloud
     fig = plt.figure(figsize=figsize, dpi=300)
@@ -96,7 +143,7 @@ def plot_wordcloud(result_df, score, output_path, figsize=(10, 3), colormap=plt.
     ax1.set_title(f"Rank indes: {score}", fontsize=18)
     
     # Generate the word cloud
-    wordcloud = WordCloud(background_color="white", width=800, height=600, max_words=1000).generate_from_frequencies(df.set_index("genename")["rank"].to_dict())
+    wordcloud = get_wordcloud().generate_from_frequencies(df_gene["rank"].to_dict())
     
     # Recolor the word cloud using the color function
     ax1.imshow(wordcloud.recolor(color_func=cfunc), interpolation="bilinear")
@@ -118,6 +165,85 @@ def plot_wordcloud(result_df, score, output_path, figsize=(10, 3), colormap=plt.
     plt.close()
     return
 
+def wordcloud_key(result_df, score, figsize, colormap):
+    """
+    Return a content hash of a word cloud.
+    The hash is the same if genes, scores and figure settings are the same.
+
+    Parameters
+    ----------
+    result_df : pandas.DataFrame
+        Top genes of the score.
+    score : str
+        A score name.
+    figsize : tuple
+    colormap : matplotlib.colors.Colormap
+
+    Returns
+    -------
+    str
+        A hex digest.
+    """
+    h = hashlib.sha256()
+    h.update(repr((score, tuple(figsize), colormap.name)).encode())
+    h.update(pd.util.hash_pandas_object(result_df[["genename", score]], index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def _init_worker():
+    # Worker processes only write files
+    plt.switch_backend("agg")
+
+def plot_wordclouds(top, output_path, figsize=(10, 3), colormap=plt.get_cmap("viridis"), processes=None, cache_dir=None):
+    """
+    Plot word clouds of many scores, in parallel and with a cache.
+
+    Parameters
+    ----------
+    top : dict(str -> pandas.DataFrame)
+        Score name to the top genes of the score.
+    output_path : str
+        Output directory. Figures are saved as <score>.png.
+    figsize : tuple
+    colormap : matplotlib.colors.Colormap
+    processes : int
+        Number of processes. Default is one per score, up to the number of CPUs.
+        Plots are made in this process if 1 or if this process is a daemon (e.g. a Pool worker).
+    cache_dir : str
+        Directory of rendered figures named by wordcloud_key().
+        A figure is copied from the cache instead of plotting if its genes and scores are unchanged.
+    """
+    tasks = []
+    for score, result_df in top.items():
+        key = None
+        if cache_dir is not None:
+            key = wordcloud_key(result_df, score, figsize, colormap)
+            cached = os.path.join(cache_dir, f"{key}.png")
+            if os.path.exists(cached):
+                shutil.copyfile(cached, f"{output_path}/{score}.png")
+                continue
+        tasks.append((score, result_df, key))
+
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    if processes > 1 and len(tasks) > 1 and not multiprocessing.current_process().daemon:
+        with ProcessPoolExecutor(min(processes, len(tasks)), initializer=_init_worker) as executor:
+            futures = [executor.submit(plot_wordcloud, result_df, score, output_path, figsize, colormap)
+                       for score, result_df, key in tasks]
+            for future in futures:
+                future.result()
+    else:
+        for score, result_df, key in tasks:
+            plot_wordcloud(result_df, score, output_path, figsize, colormap)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for score, result_df, key in tasks:
+            # write and rename, other processes may read the cache
+            tmp = os.path.join(cache_dir, f"{key}.png.{os.getpid()}")
+            shutil.copyfile(f"{output_path}/{score}.png", tmp)
+            os.replace(tmp, os.path.join(cache_dir, f"{key}.png"))
+    return
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Plot wordcloud for DEG')
     parser.add_argument('-i', '--input', help='input file', required=True)
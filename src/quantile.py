@@ -0,0 +1,127 @@
+# Quantile rank (empirical CDF) transform of the reference columns.
+#
+# data_prep.ResourceManager.marge_all() maps N (publication count) to
+# g2p_rank and gini_norm to gini_norm_rank, uniform from 0 to 1.
+# The rank of a value is its position in the sorted values divided by
+# (number of values - 1). Tied values get the same rank (ties):
+#   sklearn: the computation of sklearn QuantileTransformer(n_quantiles=n,
+#            subsample=n) fitted on all n values, which was used before
+#            (without its 1000 quantiles and subsampling, which made ranks
+#            approximate). The breakpoints are all sorted values with ranks
+#            linspace(0, 1, n), a value is the mean of np.interp() forward and
+#            backward on them, the lowest and highest values get 0 and 1.
+#            The rank of tied values is not always the average of their
+#            positions, it depends on np.interp() on repeated breakpoints.
+#   average: the average of their positions (exact mid-rank).
+#   min, max: the lowest or highest of their positions.
+#
+# The fitted breakpoints (the sorted values and their ranks, unique values
+# except for sklearn) are saved as JSON next to the reference. New values
+# (e.g. new genes, updated publication counts) are mapped with the saved
+# breakpoints, without fitting again: a value between two breakpoints is
+# linearly interpolated, a value outside them gets the rank of the nearest end.
+
+import json
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+TIES = ["sklearn", "average", "min", "max"]
+
+class QuantileRank:
+	"""Quantile rank transform, from 0 to 1.
+
+	Attributes:
+		ties: Rank of tied values, one of TIES.
+		values: Sorted fitted values (breakpoints), unique except for ties="sklearn".
+		quantiles: Rank of each breakpoint.
+		n: Number of fitted values, NaN excluded.
+	"""
+
+	def __init__(self, ties: str = "sklearn"):
+		if not (ties in TIES):
+			raise ValueError("Invalid ties. Expected one of: %s" % TIES)
+		self.ties = ties
+		self.values = None
+		self.quantiles = None
+		self.n = 0
+
+	def fit(self, values):
+		"""Fit the breakpoints to values. NaN are ignored.
+
+		Returns:
+			self
+		"""
+		values = np.asarray(values, dtype=float).ravel()
+		values = np.sort(values[~np.isnan(values)])
+		if len(values) == 0:
+			raise ValueError("QuantileRank needs at least one value to fit")
+
+		self.n = len(values)
+		if self.ties == "sklearn":
+			# QuantileTransformer._dense_fit() with a quantile for each value
+			self.quantiles = np.linspace(0, 1, self.n, endpoint=True)
+			self.values = np.maximum.accumulate(np.nanpercentile(values, self.quantiles * 100))
+			return self
+
+		# first position and number of each unique value
+		self.values, first, counts = np.unique(values, return_index=True, return_counts=True)
+		if self.ties == "min":
+			position = first
+		elif self.ties == "max":
+			position = first + counts - 1
+		else:
+			position = first + (counts - 1) / 2
+		self.quantiles = position / max(self.n - 1, 1)
+		return self
+
+	def transform(self, values):
+		"""Return the rank of values. NaN stay NaN.
+
+		Fitted values get their exact rank, others are interpolated between
+		the breakpoints.
+		"""
+		if self.values is None:
+			raise ValueError("QuantileRank is not fitted")
+		values = np.asarray(values, dtype=float)
+		if self.ties != "sklearn":
+			return np.interp(values, self.values, self.quantiles)
+
+		# QuantileTransformer._transform_col() with output_distribution="uniform"
+		ranks = 0.5 * (np.interp(values, self.values, self.quantiles)
+				 - np.interp(-values, -self.values[::-1], -self.quantiles[::-1]))
+		ranks[values == self.values[-1]] = 1
+		ranks[values == self.values[0]] = 0
+		return ranks
+
+	def fit_transform(self, values):
+		return self.fit(values).transform(values)
+
+	def to_dict(self):
+		return {"ties": self.ties, "n": self.n,
+				"values": self.values.tolist(), "quantiles": self.quantiles.tolist()}
+
+	@classmethod
+	def from_dict(cls, d):
+		transform = cls(d["ties"])
+		transform.n = d["n"]
+		transform.values = np.asarray(d["values"], dtype=float)
+		transform.quantiles = np.asarray(d["quantiles"], dtype=float)
+		return transform
+
+def save(fname, transforms):
+	"""Save fitted transforms.
+
+	Args:
+		fname: A JSON file.
+		transforms: Dictionary of column name to QuantileRank.
+	"""
+	with open(fname, "w") as f:
+		json.dump({column: transform.to_dict() for column, transform in transforms.items()}, f)
+	logger.info(f"Saved: {fname}")
+
+def load(fname):
+	"""Return the transforms saved by save(), as a dictionary of column name to QuantileRank."""
+	with open(fname) as f:
+		return {column: QuantileRank.from_dict(d) for column, d in json.load(f).items()}
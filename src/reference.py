@@ -0,0 +1,476 @@
+# Fast access to the Clover reference (DEPrior_gini_g2p).
+#
+# data_prep.ResourceManager.marge_all() writes the reference as TSV.
+# A binary copy (.bin) with a fixed layout is written next to the TSV:
+#
+#   magic (8 bytes) | header length (uint64) | JSON header | arrays
+#
+# The header lists the dtype, shape and offset of each array; arrays are
+# aligned to 64 bytes. Numeric columns are stored as they are. Text columns
+# are stored as codes into their sorted unique values (the ID dictionary).
+# Each ID column also has a CSR index: rows of the i-th ID are
+# rows[offsets[i]:offsets[i+1]].
+# The binary copy is opened with numpy.memmap, so it is not parsed or copied:
+# processes ranking in parallel share the pages of the OS page cache.
+#
+# Reference keeps one ID -> row index per ID type, so that inputs are joined
+# to the reference without building a hash table on every call.
+
+import os
+import json
+import struct
+import pathlib
+import numpy as np
+import pandas as pd
+
+import instrument
+from scores import constants, builtin, inputs as score_inputs
+
+import logging
+logger = logging.getLogger(__name__)
+
+REFERENCE_NAME = "DEPrior_gini_g2p"
+
+ID_COLUMNS = ["hgnc_symbol", "ensembl_gene_id", "entrezgene_id"]
+
+# Columns used by Clover.Rank.run()
+RANK_COLUMNS = ID_COLUMNS + ["DE_Prior_Rank", "g2p_rank", "N", "gini_norm"]
+
+# Tissue specificity columns which can be the rareness term of Glint (see gini_prepare.py),
+# from 0 (housekeeping) to 1 (tissue-specific)
+SPECIFICITY_COLUMNS = ["gini_norm", "tau", "tsi", "entropy_norm"]
+
+# Scores which do not depend on FDR (e.g. Glint, see scores.constants()) are
+# precomputed by data_prep.py, see precomputed_columns(). Those of plugins are
+# not, their formula may change without the reference being built again.
+# Floats are parsed with float_precision="round_trip": they are the values
+# data_prep.py wrote (the default parser may differ in the last bit), so the
+# precomputed scores are the same as those calculated from the read columns.
+
+# Change the last digit when the layout is changed
+BINARY_MAGIC = b"CLVREF01"
+ALIGN = 64
+
+def _source_stat(tsv_file):
+	"""Size and modification time of the TSV reference.
+
+	These are stored in the binary copy to find out if the copy is stale.
+	"""
+	stat = os.stat(tsv_file)
+	return [stat.st_size, stat.st_mtime_ns]
+
+def _align(offset):
+	return -(-offset // ALIGN) * ALIGN
+
+def _csr(codes, n_keys):
+	"""Group row positions by code.
+
+	Returns:
+		counts: Number of rows of each code.
+		offsets: Rows of code i are rows[offsets[i]:offsets[i+1]].
+		rows: Row positions, in the original order within a code. Rows with code -1 are left out.
+	"""
+	valid = np.flatnonzero(codes >= 0)
+	rows = valid[np.argsort(codes[valid], kind="stable")]
+	counts = np.bincount(codes[valid], minlength=n_keys)
+	offsets = np.concatenate(([0], np.cumsum(counts)))
+	return counts, offsets, rows
+
+def binary_path(tsv_file):
+	"""Return the path of the binary copy of tsv_file."""
+	p_file = pathlib.Path(tsv_file)
+	return str(p_file.with_suffix(".bin"))
+
+def write_binary(tsv_file):
+	"""Write the binary copy of the TSV reference.
+
+	The copy is built from the written TSV file, so that reading the copy
+	returns the same values and dtypes as reading the TSV.
+	The file is replaced atomically, processes which have the old copy
+	mapped keep reading the old copy.
+
+	Args:
+		tsv_file: A path of the TSV reference.
+
+	Returns:
+		bin_file: A path of the written binary copy.
+	"""
+	df = pd.read_csv(tsv_file, sep="\t", float_precision="round_trip")
+	arrays = {}
+	columns = {}
+	for column in df.columns:
+		values = df[column]
+		if values.dtype == object:
+			codes, keys = pd.factorize(values, sort=True)
+			arrays[f"{column}.codes"] = codes.astype(np.int32)
+			arrays[f"{column}.keys"] = np.array(keys, dtype=str)
+			columns[column] = "codes"
+		else:
+			arrays[column] = values.to_numpy()
+			columns[column] = "values"
+			if column in ID_COLUMNS:
+				codes, keys = pd.factorize(values, sort=True)
+				arrays[f"{column}.keys"] = np.asarray(keys)
+
+		if column in ID_COLUMNS:
+			counts, offsets, rows = _csr(codes, len(keys))
+			arrays[f"{column}.offsets"] = offsets.astype(np.int64)
+			arrays[f"{column}.rows"] = rows.astype(np.int64)
+
+	layout = {}
+	size = 0
+	for name, array in arrays.items():
+		size = _align(size)
+		layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": size}
+		size += array.nbytes
+	header = json.dumps({"source": _source_stat(tsv_file), "n_rows": len(df),
+						 "columns": columns, "arrays": layout}).encode()
+	start = _align(len(BINARY_MAGIC) + 8 + len(header))
+
+	bin_file = binary_path(tsv_file)
+	with open(bin_file + ".tmp", "wb") as f:
+		f.write(BINARY_MAGIC)
+		f.write(struct.pack("<Q", len(header)))
+		f.write(header)
+		for name, array in arrays.items():
+			f.seek(start + layout[name]["offset"])
+			f.write(np.ascontiguousarray(array).tobytes())
+		f.truncate(start + size)
+	os.replace(bin_file + ".tmp", bin_file)
+	logger.info(f"Saved: {bin_file}")
+	return bin_file
+
+def open_binary(tsv_file):
+	"""Map the binary copy of the TSV reference.
+
+	Args:
+		tsv_file: A path of the TSV reference.
+
+	Returns:
+		(header, arrays): The JSON header and a dictionary of read-only arrays
+		backed by the file, or None if the binary copy is missing or stale.
+	"""
+	bin_file = binary_path(tsv_file)
+	if not os.path.exists(bin_file):
+		return None
+
+	with open(bin_file, "rb") as f:
+		if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+			logger.warning(f"{bin_file} has an unknown format. Use TSV.")
+			return None
+		(length,) = struct.unpack("<Q", f.read(8))
+		header = json.loads(f.read(length))
+	if header["source"] != _source_stat(tsv_file):
+		logger.warning(f"{bin_file} is older than {tsv_file}. Use TSV.")
+		return None
+
+	start = _align(len(BINARY_MAGIC) + 8 + length)
+	buffer = np.memmap(bin_file, dtype=np.uint8, mode="r")
+	arrays = {}
+	for name, array in header["arrays"].items():
+		dtype = np.dtype(array["dtype"])
+		offset = start + array["offset"]
+		nbytes = dtype.itemsize * int(np.prod(array["shape"]))
+		# plain ndarray views of the mapped file
+		arrays[name] = np.asarray(buffer[offset:offset + nbytes]).view(dtype).reshape(array["shape"])
+	return header, arrays
+
+def _column_values(header, arrays, column, rows=None):
+	"""Return values of a column of the binary copy as in the TSV, at rows (-1: NaN)."""
+	if header["columns"][column] == "values":
+		values = arrays[column]
+		if rows is None:
+			return np.array(values)
+		return pd.api.extensions.take(values, rows, allow_fill=True)
+
+	codes = arrays[f"{column}.codes"]
+	if rows is not None:
+		codes = np.where(rows >= 0, codes.take(rows), -1)
+	values = arrays[f"{column}.keys"].take(codes).astype(object)
+	values[codes < 0] = np.nan
+	return values
+
+def read_binary(tsv_file, columns=None):
+	"""Read the binary copy of the TSV reference.
+
+	Args:
+		tsv_file: A path of the TSV reference.
+		columns: A list of columns to load. Default is all columns.
+
+	Returns:
+		pandas.DataFrame, or None if the binary copy is missing or stale.
+	"""
+	binary = open_binary(tsv_file)
+	if binary is None:
+		return None
+	header, arrays = binary
+
+	if columns is None:
+		columns = list(header["columns"])
+	elif not set(columns) <= set(header["columns"]):
+		logger.warning(f"{binary_path(tsv_file)} does not have all of {columns}. Use TSV.")
+		return None
+	return pd.DataFrame({column: _column_values(header, arrays, column) for column in columns},
+					 columns=columns)
+
+def read_reference(resources_path, columns=None):
+	"""Read the reference, prefer the binary copy.
+
+	Args:
+		resources_path: A folder which has DEPrior_gini_g2p.txt.
+		columns: A list of columns to load. Default is all columns.
+
+	Returns:
+		pandas.DataFrame of the reference.
+	"""
+	tsv_file = f"{resources_path}/{REFERENCE_NAME}.txt"
+	if not os.path.exists(tsv_file):
+		raise ValueError(f"Resource data do not exists in {resources_path}: Please run `python src/data_prep.py`")
+
+	df = read_binary(tsv_file, columns)
+	if df is None:
+		if columns is not None:
+			header = pd.read_csv(tsv_file, sep="\t", nrows=0).columns
+			missing = [c for c in columns if not c in header]
+			if missing:
+				raise ValueError(f"column: {missing} not in reference. Build the reference again with data_prep.py")
+		df = pd.read_csv(tsv_file, sep="\t", usecols=columns, float_precision="round_trip")
+		if columns is not None:
+			df = df[columns]
+	return df
+
+class IdIndex(object):
+	"""Lookup from one ID type to row positions of the reference.
+
+	The index is built once. One ID may map to several rows (e.g. a gene
+	symbol with several Ensembl IDs); the rows of one ID are kept in the
+	order of the reference, so joins are deterministic.
+
+	Attributes:
+		keys: The unique IDs, pandas.Index or a sorted numpy array (see from_sorted()).
+		offsets: Rows of keys[i] are rows[offsets[i]:offsets[i+1]].
+		rows: Row positions of the reference grouped by ID.
+	"""
+	def __init__(self, values):
+		codes, uniques = pd.factorize(values)
+		# rows without ID can not be matched
+		self.counts, self.offsets, self.rows = _csr(codes, len(uniques))
+		self.keys = pd.Index(uniques)
+		self.sorted = False
+		self.unique = bool((self.counts <= 1).all())
+
+	@classmethod
+	def from_sorted(cls, keys, offsets, rows):
+		"""Index on the arrays of the binary copy, IDs are found by binary search.
+
+		Args:
+			keys: Sorted unique IDs.
+			offsets: Rows of keys[i] are rows[offsets[i]:offsets[i+1]].
+			rows: Row positions of the reference grouped by ID.
+		"""
+		index = cls.__new__(cls)
+		index.keys = keys
+		index.offsets = offsets
+		index.rows = rows
+		index.counts = np.diff(offsets)
+		index.sorted = True
+		index.unique = bool((index.counts <= 1).all())
+		return index
+
+	def _find(self, query):
+		"""Return positions of query in keys, -1 if not found."""
+		if not self.sorted:
+			return self.keys.get_indexer(query)
+
+		query = np.asarray(query)
+		missing = np.zeros(len(query), dtype=bool)
+		if self.keys.dtype.kind == "U" and query.dtype.kind == "O" \
+				and pd.api.types.infer_dtype(query, skipna=True) in ("string", "empty"):
+			missing = pd.isna(query)
+			query = np.where(missing, "", query).astype(str)
+		elif not ((self.keys.dtype.kind == "U" and query.dtype.kind == "U")
+				or (self.keys.dtype.kind in "iuf" and query.dtype.kind in "iuf")):
+			# IDs of another type, e.g. numbers in an object array
+			return pd.Index(self.keys).get_indexer(query)
+
+		if len(self.keys) == 0:
+			return np.full(len(query), -1)
+		k = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+		found = (self.keys[k] == query) & ~missing
+		return np.where(found, k, -1)
+
+	def lookup(self, query):
+		"""Find reference rows of each query ID.
+
+		Same rows and order as a left pandas.merge() with the reference.
+
+		Args:
+			query: array-like of IDs.
+
+		Returns:
+			left: Positions in query, repeated if the ID has several rows.
+			right: Row positions of the reference, -1 if not found.
+		"""
+		k = self._find(query)
+		found = k >= 0
+		if self.unique:
+			right = np.full(len(k), -1)
+			right[found] = self.rows[k[found]]
+			return np.arange(len(k)), right
+
+		counts = np.where(found, self.counts[k], 1)
+		left = np.repeat(np.arange(len(k)), counts)
+		matched = np.repeat(found, counts)
+		start = np.repeat(self.offsets[k], counts)
+		within = np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+		right = np.full(len(left), -1)
+		right[matched] = self.rows[(start + within)[matched]]
+		return left, right
+
+class Reference(object):
+	"""The reference with prebuilt indexes for every ID type.
+
+	Build once and reuse to rank many inputs.
+	A Reference from the binary copy (see from_binary()) reads the mapped
+	arrays, only the joined rows are copied.
+
+	Attributes:
+		columns: Column names of the reference.
+		indexes: Dictionary of IdIndex. Keys are ID types in ID_COLUMNS.
+	"""
+	def __init__(self, table):
+		self._table = table.reset_index(drop=True)
+		self._binary = None
+		self.columns = list(self._table.columns)
+		self.indexes = {id_type: IdIndex(self._table[id_type].to_numpy())
+				  for id_type in ID_COLUMNS if id_type in self.columns}
+
+	@classmethod
+	def from_binary(cls, binary, columns=None):
+		"""Reference on the binary copy.
+
+		Args:
+			binary: Output of open_binary().
+			columns: A list of columns to use. Default is all columns.
+		"""
+		header, arrays = binary
+		reference = cls.__new__(cls)
+		reference._table = None
+		reference._binary = binary
+		reference.columns = list(header["columns"]) if columns is None else list(columns)
+		reference.indexes = {id_type: IdIndex.from_sorted(arrays[f"{id_type}.keys"],
+										arrays[f"{id_type}.offsets"], arrays[f"{id_type}.rows"])
+				  for id_type in ID_COLUMNS if id_type in reference.columns}
+		return reference
+
+	@property
+	def table(self):
+		"""pandas.DataFrame of the reference."""
+		if self._table is None:
+			header, arrays = self._binary
+			self._table = pd.DataFrame({column: _column_values(header, arrays, column)
+							   for column in self.columns}, columns=self.columns)
+		return self._table
+
+	def take(self, column, rows):
+		"""Return values of column at rows of the reference, NaN at rows -1."""
+		if self._binary is not None:
+			return _column_values(*self._binary, column, rows)
+		return pd.api.extensions.take(self._table[column].to_numpy(), rows, allow_fill=True)
+
+	def lookup(self, df, left_on, id_type):
+		"""Return the rows of a left join of the reference to df.
+
+		Returns:
+			(left, right): Row positions in df and in the reference (-1: no reference row).
+		"""
+		left, right = self.indexes[id_type].lookup(df[left_on].to_numpy())
+		if instrument.enabled():
+			# unmatched: input rows without a reference row
+			instrument.count(rows_in=len(df), rows_out=len(left), unmatched=np.count_nonzero(right < 0))
+		return left, right
+
+	def join(self, df, left_on, id_type, columns=None, rows=None):
+		"""Left join the reference to df.
+
+		Same result as
+		pandas.merge(df, table[columns], left_on=left_on, right_on=id_type, how="left")
+
+		Args:
+			df: pandas.DataFrame.
+			left_on: A column name of IDs in df.
+			id_type: Choose from ["hgnc_symbol", "ensembl_gene_id", "entrezgene_id"].
+			columns: A list of reference columns to add. Default is all columns.
+			rows: Output of lookup(), to take more columns at the same rows (see take()).
+				The default looks up df.
+
+		Returns:
+			pandas.DataFrame of df with the reference columns.
+		"""
+		if columns is None:
+			columns = self.columns
+
+		left, right = self.lookup(df, left_on, id_type) if rows is None else rows
+
+		if len(left) == len(df):
+			df_left = df.reset_index(drop=True)
+		else:
+			df_left = df.take(left).reset_index(drop=True)
+
+		df_right = pd.DataFrame({column: self.take(column, right) for column in columns})
+
+		# Same suffixes as pandas.merge()
+		overlap = set(df_left.columns) & set(df_right.columns)
+		if overlap:
+			df_left = df_left.rename(columns={c: f"{c}_x" for c in overlap})
+			df_right = df_right.rename(columns={c: f"{c}_y" for c in overlap})
+
+		return pd.concat([df_left, df_right], axis=1)
+
+def rank_columns(specificity="gini_norm"):
+	"""Return the columns used by Clover.Rank.run() with a specificity column of SPECIFICITY_COLUMNS."""
+	if not (specificity in SPECIFICITY_COLUMNS):
+		raise ValueError("Invalid specificity. Expected one of: %s" % SPECIFICITY_COLUMNS)
+	return RANK_COLUMNS + [c for c in [specificity] if not c in RANK_COLUMNS]
+
+def precomputed_columns(specificity="gini_norm", scores=None):
+	"""Return a dictionary of score name to the reference column of the precomputed score.
+
+	Only the scores of scores.py are precomputed, not those of plugins.
+
+	A score which depends on the specificity column (e.g. Glint) is stored for
+	each of SPECIFICITY_COLUMNS as <score>.<specificity>, others (e.g. g2p_rank_inv)
+	as <score>.
+
+	Args:
+		specificity: One of SPECIFICITY_COLUMNS.
+		scores: A list of score names. Default is all registered scores.
+	"""
+	return {name: f"{name}.{specificity}" if "specificity" in score_inputs([name]) else name
+		 for name in constants(scores) if builtin(name)}
+
+def load_reference(resources_path, columns=None, optional=None):
+	"""Open the reference and build ID indexes.
+
+	The binary copy is mapped if it is up to date, the TSV is read otherwise.
+
+	Args:
+		resources_path: A folder which has DEPrior_gini_g2p.txt.
+		columns: A list of columns to load. Default is all columns.
+		optional: A list of columns to load if the reference has them
+			(e.g. precomputed scores, missing in a reference built before).
+
+	Returns:
+		Reference.
+	"""
+	tsv_file = f"{resources_path}/{REFERENCE_NAME}.txt"
+	if os.path.exists(tsv_file):
+		binary = open_binary(tsv_file)
+		if binary is not None and (columns is None or set(columns) <= set(binary[0]["columns"])):
+			if columns is not None and optional:
+				columns = columns + [c for c in optional if c in binary[0]["columns"] and not c in columns]
+			return Reference.from_binary(binary, columns)
+		if columns is not None and optional:
+			header = pd.read_csv(tsv_file, sep="\t", nrows=0).columns
+			columns = columns + [c for c in optional if c in header and not c in columns]
+	return Reference(read_reference(resources_path, columns))
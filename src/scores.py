@@ -1,5 +1,81 @@
+import os
+import importlib
 import numpy as np
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Modules which register more scores when scores is imported, comma separated
+PLUGINS_ENV = "CLOVER_SCORE_PLUGINS"
+# "numpy" (default) or "numexpr" to evaluate the scores which have an expression
+ENGINE_ENV = "CLOVER_SCORE_ENGINE"
+
+
+class Score:
+    """
+    A ranking score in the registry.
+
+    Parameters
+    ----------
+    name : str
+        Column name of the score in the result.
+    inputs : list of str
+        Names of the arguments of func: reference columns (e.g. DE_Prior_Rank,
+        g2p_rank), "FDR", "specificity" (the tissue specificity column, see
+        Clover.py --specificity) or other scores.
+    func : callable
+        Return the score from the inputs (numpy arrays). Arrays are broadcast,
+        in Clover.RankMatrix FDR is (genes, comparisons) and the others (genes, 1).
+    ascending : bool
+        True if a smaller value ranks higher (e.g. FDR, Glint).
+    expr : str, optional
+        The same formula as a numexpr expression of the inputs.
+    output : bool
+        False for an intermediate of other scores (e.g. rareness), which is
+        not written to the result.
+    """
+
+    def __init__(self, name, inputs, func, ascending=False, expr=None, output=True):
+        self.name = name
+        self.inputs = list(inputs)
+        self.func = func
+        self.ascending = ascending
+        self.expr = expr
+        self.output = output
+
+
+# Score name to Score, in the order of the result columns
+REGISTRY = {}
+
+
+def register(name, inputs, ascending=False, expr=None, output=True):
+    """
+    Register a function as a score, used as a decorator.
+
+    A score registered by a plugin module (see PLUGINS_ENV) is calculated,
+    written and plotted like the scores of this module.
+
+    Parameters
+    ----------
+    name, inputs, ascending, expr, output
+        See Score.
+
+    Examples
+    --------
+    >>> @register("Rare_DEG", inputs=["Dowsing", "N"])
+    ... def rare_deg(dowsing, n):
+    ...     return dowsing / np.log2(n + 2)
+    """
+    def decorator(func):
+        REGISTRY[name] = Score(name, inputs, func, ascending, expr, output)
+        return func
+    return decorator
+
+
+@register("Glint", inputs=["DE_Prior_Rank", "specificity"], ascending=True,
+          expr="DE_Prior_Rank * log(2 / (specificity + 1)) / log(2)")
 def glint(de_prior, gini):
     """
     By this score, the user can rank the genes which is:
@@ -10,23 +86,228 @@ def glint(de_prior, gini):
     = 0.2 x np.log2(1/0.9) = 0.0649
     Larger score -> used to be DEG and Housekeeping gene
     = 0.9 x np.log2(1/0.2) = 0.7003
+
+    gini is gini_norm, or another tissue specificity from 0 to 1
+    (tau, tsi, entropy_norm; see Clover.py --specificity).
     """
-    prob = de_prior # close to 1: More DEG
-    ts = np.log2(2/(gini +1)) # 1: More housekeeping, 0: More TS
-    return prob * ts
-    
+    prob = np.asarray(de_prior, dtype=float) # close to 1: More DEG
+    # ts = np.log2(2/(gini +1)) without temporaries
+    ts = np.asarray(gini, dtype=float) + 1
+    np.divide(2, ts, out=ts)
+    np.log2(ts, out=ts) # 1: More housekeeping, 0: More TS
+    ts *= prob
+    return ts
+
 
 def dowsing(de_prior, gini, fdr):
     rare_deg = glint(de_prior, gini)
-    rareness = np.log2(2/(rare_deg+1))
-    return rareness * -np.log10(fdr)
+    return dowsing_glint(rare_deg, fdr)
+
+def dowsing_glint(rare_deg, fdr):
+    """
+    Dowsing score from a precomputed Glint score.
+    Arrays are broadcast, so rare_deg of shape (genes, 1) and
+    fdr of shape (genes, comparisons) return all comparisons at once.
+    """
+    return dowsing_rareness(rareness(rare_deg), fdr)
+
+@register("rareness", inputs=["Glint"], output=False, expr="log(2 / (Glint + 1)) / log(2)")
+def rareness(rare_deg):
+    """
+    rareness = np.log2(2/(rare_deg+1)), the Glint term of Dowsing.
+    It does not depend on FDR, so it is precomputed in the reference.
+    """
+    rareness = np.asarray(rare_deg, dtype=float) + 1
+    np.divide(2, rareness, out=rareness)
+    np.log2(rareness, out=rareness)
+    return rareness
+
+@register("Dowsing", inputs=["rareness", "FDR"], expr="rareness * -log10(FDR)")
+def dowsing_rareness(rareness, fdr):
+    """
+    Dowsing score from a precomputed rareness.
+    """
+    # rareness * -np.log10(fdr)
+    score = np.log10(np.asarray(fdr, dtype=float))
+    np.negative(score, out=score)
+    score *= rareness
+    return score
+
+@register("g2p_rank_inv", inputs=["g2p_rank"], output=False, expr="1 - g2p_rank")
+def g2p_rank_inv(g2p_rank):
+    """
+    1 - g2p_rank, the weight of Treasure_Hunt: close to 1 for rarely studied genes.
+    """
+    return 1 - g2p_rank
 
 def treasure_hunt(g2p_rank, dowsing):
     a = 1 - g2p_rank
     b = dowsing
     return a * b
 
+@register("Treasure_Hunt", inputs=["g2p_rank_inv", "Dowsing"], expr="g2p_rank_inv * Dowsing")
+def _treasure_hunt_inv(g2p_rank_inv, dowsing):
+    """
+    Treasure_Hunt from a precomputed g2p_rank_inv (1 - g2p_rank).
+    """
+    return g2p_rank_inv * dowsing
+
+@register("Ropeway", inputs=["g2p_rank", "Dowsing"], expr="g2p_rank * Dowsing")
 def ropeway(g2p_rank, dowsing):
     a = g2p_rank
     b = dowsing
-    return a * b
\ No newline at end of file
+    return a * b
+
+
+def score_names():
+    """
+    Return the names of the registered scores, in the order of the result columns.
+    Intermediates (output=False) are not included.
+    """
+    return [name for name, score in REGISTRY.items() if score.output]
+
+
+def ascending(name):
+    """
+    Return True if a smaller value of the score (or FDR) ranks higher.
+    """
+    if name == "FDR":
+        return True
+    return name in REGISTRY and REGISTRY[name].ascending
+
+
+def _resolve(names):
+    """
+    Return names and the scores they depend on, each once, dependencies first.
+    """
+    order = []
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name in path:
+            raise ValueError(f"score: circular inputs {path + [name]}")
+        for i in REGISTRY[name].inputs:
+            if i in REGISTRY:
+                visit(i, path + [name])
+        order.append(name)
+
+    for name in names:
+        if not name in REGISTRY:
+            raise ValueError("Invalid score: %s. Expected one of: %s" % (name, score_names()))
+        visit(name, [])
+    return order
+
+
+def inputs(names=None):
+    """
+    Return the inputs of scores (and the scores they depend on) which are not scores.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Score names. Default is all registered scores.
+    """
+    names = score_names() if names is None else names
+    columns = []
+    for name in _resolve(names):
+        columns += [i for i in REGISTRY[name].inputs if not i in REGISTRY and not i in columns]
+    return columns
+
+
+def builtin(name):
+    """
+    Return True if the score is registered by this module, not by a plugin.
+    """
+    return REGISTRY[name].func.__module__ == __name__
+
+
+def per_comparison(name):
+    """
+    Return True if the score depends on FDR, so has one value per comparison.
+    """
+    return "FDR" in inputs([name])
+
+
+def constants(names=None):
+    """
+    Return the scores which do not depend on FDR (e.g. Glint, rareness),
+    among names and the scores they depend on, dependencies first.
+
+    They are per-gene constants. Those of this module (see builtin())
+    are precomputed in the reference by data_prep.py
+    (see reference.precomputed_columns()).
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Score names. Default is all registered scores.
+    """
+    names = score_names() if names is None else names
+    return [name for name in _resolve(names) if not per_comparison(name)]
+
+
+def evaluate(columns, names=None, engine=None):
+    """
+    Calculate scores in one pass over the input arrays.
+
+    Each score is calculated once: a score which is the input of another
+    (e.g. Glint of Dowsing) is reused, not calculated again. A score which
+    is in columns (e.g. precomputed in the reference) is not calculated.
+
+    Parameters
+    ----------
+    columns : dict
+        Input name to numpy array, with all of inputs(names).
+    names : list of str, optional
+        Scores to return. Default is all registered scores.
+    engine : str, optional
+        "numpy" or "numexpr". numexpr evaluates the scores which have an
+        expression in one multithreaded loop without temporaries (results
+        may differ in the last bits). Default is $CLOVER_SCORE_ENGINE or numpy.
+
+    Returns
+    -------
+    dict
+        Score name to numpy array, in the order of names.
+    """
+    names = score_names() if names is None else list(names)
+    engine = engine or os.environ.get(ENGINE_ENV, "numpy")
+    if not engine in ["numpy", "numexpr"]:
+        raise ValueError("Invalid score engine: %s. Expected one of: ['numpy', 'numexpr']" % engine)
+    if engine == "numexpr" and numexpr is None:
+        raise ValueError("score engine numexpr needs numexpr: pip install numexpr")
+
+    missing = [i for i in inputs(names) if not i in columns]
+    if missing:
+        raise ValueError(f"score: inputs {missing} are missing")
+
+    values = dict(columns)
+    for name in _resolve(names):
+        if name in values:
+            continue
+        score = REGISTRY[name]
+        args = [values[i] for i in score.inputs]
+        if engine == "numexpr" and score.expr is not None:
+            values[name] = numexpr.evaluate(score.expr, local_dict=dict(zip(score.inputs, args)))
+        else:
+            values[name] = score.func(*args)
+    return {name: values[name] for name in names}
+
+
+def load_plugins(modules=None):
+    """
+    Import modules which register more scores.
+
+    Parameters
+    ----------
+    modules : list of str, optional
+        Module names. Default is $CLOVER_SCORE_PLUGINS (comma separated).
+    """
+    if modules is None:
+        modules = [m.strip() for m in os.environ.get(PLUGINS_ENV, "").split(",") if m.strip()]
+    for module in modules:
+        importlib.import_module(module)
+
+
+load_plugins()
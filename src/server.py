@@ -0,0 +1,195 @@
+# Clover ranking server.
+#
+# The reference is loaded once by Clover.RankEngine, then worker processes
+# are forked. The workers share the memory of the reference: the binary copy
+# is a memory-mapped file (see reference.py), and other objects are shared
+# copy-on-write (they are frozen out of the garbage collector so that their
+# pages are not written). The workers accept requests on the same listening socket.
+#
+# Usage:
+# python3 server.py --port 8080 --workers 4
+#
+# Rank a DEG list (CSV with gene and FDR columns, same as Clover.py --input):
+# curl --data-binary @test_imput_DEG.csv "http://localhost:8080/rank?id_type=hgnc_symbol"
+#
+# Query parameters of /rank:
+# id_type (required), gene_column, fdr_column, sep (default ","),
+# fdr_columns (comma-separated, ranks all comparisons as Clover.py --fdr_columns),
+# tidy (with fdr_columns), format ("csv" or "json", default "csv").
+# GET /health returns "ok".
+
+import io
+import os
+import json
+import gc
+import sys
+import signal
+import argparse
+import http.server
+import urllib.parse
+import pandas as pd
+
+from Clover import RankEngine
+from reference import SPECIFICITY_COLUMNS
+
+import logging
+logger = logging.getLogger(__name__)
+
+def rank_request(engine, body, params):
+	"""Rank the body of a /rank request.
+
+	Args:
+		engine: Clover.RankEngine.
+		body: Bytes of the input table.
+		params: Dictionary of the query parameters.
+
+	Returns:
+		(content type, bytes of the result)
+
+	Raises:
+		ValueError: An error occurs when the request is invalid.
+	"""
+	output_format = params.get("format", "csv")
+	if not output_format in ("csv", "json"):
+		raise ValueError(f"Invalid format: {output_format}")
+
+	df = pd.read_csv(io.BytesIO(body), sep=params.get("sep", ","))
+	if "fdr_columns" in params:
+		result = engine.rank_matrix(df, params.get("id_type"), params.get("gene_column"),
+							  params["fdr_columns"].split(","), params.get("tidy", "false").lower() == "true")
+	else:
+		result = engine.rank(df, params.get("id_type"), params.get("gene_column"), params.get("fdr_column"))
+
+	if output_format == "json":
+		# json keeps all digits of floats, DataFrame.to_json() rounds them to 10 decimals.
+		# NaN is written as null.
+		records = result.astype(object).where(result.notna(), None).to_dict("records")
+		return "application/json", json.dumps(records, allow_nan=False).encode()
+	return "text/csv", result.to_csv().encode()
+
+def handler_class(engine):
+	"""Return a request handler class which ranks with engine."""
+
+	class RankHandler(http.server.BaseHTTPRequestHandler):
+
+		def _send(self, code, content_type, body):
+			self.send_response(code)
+			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			if urllib.parse.urlsplit(self.path).path == "/health":
+				self._send(200, "text/plain", b"ok")
+			else:
+				self._send(404, "text/plain", b"not found")
+
+		def do_POST(self):
+			url = urllib.parse.urlsplit(self.path)
+			if url.path != "/rank":
+				self._send(404, "text/plain", b"not found")
+				return
+			params = dict(urllib.parse.parse_qsl(url.query))
+			body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+			try:
+				content_type, result = rank_request(engine, body, params)
+			except (ValueError, KeyError, pd.errors.ParserError) as e:
+				self._send(400, "text/plain", str(e).encode())
+				return
+			except Exception as e:
+				logger.exception("rank ERROR")
+				self._send(500, "text/plain", str(e).encode())
+				return
+			self._send(200, content_type, result)
+
+		def log_message(self, format, *args):
+			logger.debug(format % args)
+
+	return RankHandler
+
+def serve(engine, host="127.0.0.1", port=8080, workers=1):
+	"""Serve engine over HTTP with pre-forked worker processes.
+
+	Args:
+		engine: Clover.RankEngine, loaded before the workers are forked.
+		host: Host to listen on.
+		port: Port to listen on.
+		workers: Number of worker processes. 1 serves in this process.
+	"""
+	server = http.server.HTTPServer((host, port), handler_class(engine))
+	logger.info(f"Serving on {host}:{port} with {workers} workers")
+
+	engine.warmup()
+	# Objects created so far are not tracked by the garbage collector any more,
+	# so the workers do not write to (and copy) the pages of the reference.
+	gc.freeze()
+
+	if workers <= 1 or not hasattr(os, "fork"):
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+		return
+
+	# Stop the workers on SIGTERM too, e.g. from systemd or docker stop
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	children = []
+	for i in range(workers):
+		pid = os.fork()
+		if pid == 0:
+			try:
+				server.serve_forever()
+			except (KeyboardInterrupt, SystemExit):
+				pass
+			finally:
+				os._exit(0)
+		children.append(pid)
+
+	try:
+		for pid in children:
+			os.waitpid(pid, 0)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		server.server_close()
+	return
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve Clover ranking over HTTP.')
+	parser.add_argument("--host",
+					type=str,
+					default="127.0.0.1",
+					help="Host to listen on")
+	parser.add_argument("--port",
+					type=int,
+					default=8080,
+					help="Port to listen on")
+	parser.add_argument("--workers",
+					type=int,
+					default=1,
+					help="Number of worker processes sharing the reference")
+	parser.add_argument("--resources_path",
+					type=str,
+					default=None,
+					help="A folder which has DEPrior_gini_g2p.txt. Default is data in current directory")
+	parser.add_argument("--specificity",
+					type=str,
+					choices=SPECIFICITY_COLUMNS,
+					default="gini_norm",
+					help="Tissue specificity column of the reference used in Glint and Dowsing")
+	parser.add_argument("--scores",
+					type=str,
+					nargs="+",
+					default=None,
+					help="Scores to calculate. Default is all registered scores, with those of $CLOVER_SCORE_PLUGINS")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+	serve(RankEngine(args.resources_path, specificity=args.specificity, scores=args.scores), args.host, args.port, args.workers)